@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import contextlib
+import statistics
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+SM_DEFINITION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sh-remediation-sm.json')
+sys.path.insert(0, SRC_DIR)
+
+# moto accounts are any 12 digit ids, the default one plays the Master Account
+MASTER_ACCOUNT = '123456789012'
+HOME_REGION = 'us-east-1'
+# latency changes below this are timer and scheduler noise, not regressions
+LATENCY_NOISE_MS = 5
+
+# minimal stand-in for cis-benchmark-remediation.yaml with the same Parameters
+TEMPLATE = '''AWSTemplateFormatVersion: 2010-09-09
+Parameters:
+  AdministratorARN:
+    Type: String
+  AdminSNSNotificationEmailAddress:
+    Type: String
+Resources:
+  AlarmTopic:
+    Type: AWS::SNS::Topic
+    Properties:
+      TopicName: sh-remediation-alarms
+'''
+
+ENVIRONMENT = {
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': HOME_REGION,
+    'org_id': 'o-a4tlobvmc0',
+    'assume_role': 'AWSControlTowerExecution',
+    'master_account': MASTER_ACCOUNT,
+    'home_region': HOME_REGION,
+    'master_bucket': 'org-sh-ops',
+    'sh_admin_account': '413157014023',
+    'member_bucket': 'sh-ops',
+    'cfn_template_name': 'cis-benchmark-remediation.yaml',
+    'sm_name': 'SHRemediatorSM'
+}
+
+parser = argparse.ArgumentParser(description='Offline benchmark of the remediation pipeline against moto')
+parser.add_argument('--bursts', default='1,10,100,1000', help='comma separated burst sizes in accounts')
+parser.add_argument('--workers', type=int, default=1, help='accounts processed in parallel')
+parser.add_argument('--json', action='store_true', help='print one JSON result per burst')
+parser.add_argument('--ledger', action='store_true', help='record progress in a DynamoDB ledger table')
+parser.add_argument('--fused', action='store_true', help='copy and launch through the fused SHRemediationPipeline handler')
+parser.add_argument('--baseline', help='--json output of an earlier run; exit 1 when a burst regressed against it')
+parser.add_argument('--tolerance', type=float, default=20, help='latency increase in percent tolerated against --baseline')
+
+class Context:
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+
+class ApiCounter:
+    def __init__(self):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def hook(self, client):
+        client.meta.events.register('before-call', self.count)
+
+    def count(self, model, **kwargs):
+        with self.lock:
+            self.calls[model.service_model.service_name] += 1
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def setup_master(sh_clients):
+    s3_client = sh_clients.get_client('s3')
+    s3_client.create_bucket(Bucket=ENVIRONMENT['master_bucket'])
+    s3_client.put_object(Bucket=ENVIRONMENT['master_bucket'], Key=ENVIRONMENT['cfn_template_name'], Body=TEMPLATE)
+    sfn_client = sh_clients.get_client('stepfunctions')
+    with open(SM_DEFINITION) as definition:
+        sfn_client.create_state_machine(
+            name=ENVIRONMENT['sm_name'],
+            definition=definition.read(),
+            roleArn='arn:aws:iam::{}:role/SHRemediatorSMExecRole'.format(MASTER_ACCOUNT))
+
+def setup_ledger(sh_clients, table_name):
+    sh_clients.get_client('dynamodb').create_table(
+        TableName=table_name,
+        BillingMode='PAY_PER_REQUEST',
+        AttributeDefinitions=[
+            {'AttributeName': 'member_account', 'AttributeType': 'S'},
+            {'AttributeName': 'status', 'AttributeType': 'S'}
+        ],
+        KeySchema=[{'AttributeName': 'member_account', 'KeyType': 'HASH'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'status-index',
+            'KeySchema': [
+                {'AttributeName': 'status', 'KeyType': 'HASH'},
+                {'AttributeName': 'member_account', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'KEYS_ONLY'}
+        }])
+
+def enrollment_event(member_account):
+    return {
+        'id': str(uuid.uuid4()),
+        'source': 'org.SHEnablerEvent',
+        'detail-type': 'SHEnablerSM Event',
+        'detail': {
+            'EventName': 'SecurityHubEnabled',
+            'serviceEventDetails': {
+                'securityHubEnabledAccount': {
+                    'member_account': member_account,
+                    'member_email': 'sh-{}@example.com'.format(member_account)
+                }
+            }
+        }
+    }
+
+def run_account(handlers, member_account, latencies, fused=False):
+    launcher, sh_ops_bucket, sh_remediator, sh_pipeline = handlers
+    started = time.perf_counter()
+    launcher.lambda_handler(enrollment_event(member_account), Context('SHRemediatorSMLauncher'))
+    launched = time.perf_counter()
+    member_data = {
+        'member_account': member_account,
+        'member_email': 'sh-{}@example.com'.format(member_account)
+    }
+    copier_input = launcher.prepare_input({}, member_data)
+    latencies['launcher'].append((launched - started) * 1000)
+    if fused:
+        sh_pipeline.lambda_handler(copier_input, Context('SHRemediationPipeline'))
+        remediated = time.perf_counter()
+        latencies['pipeline'].append((remediated - launched) * 1000)
+    else:
+        copied = sh_ops_bucket.lambda_handler(copier_input, Context('SHOpsBucketCopier'))
+        copied_at = time.perf_counter()
+        sh_remediator.lambda_handler(copied, Context('SHRemediator'))
+        remediated = time.perf_counter()
+        latencies['copier'].append((copied_at - launched) * 1000)
+        latencies['remediator'].append((remediated - copied_at) * 1000)
+    latencies['end_to_end'].append((remediated - started) * 1000)
+
+def run_burst(handlers, size, workers, counter, first_account, fused=False):
+    accounts = [str(first_account + index).zfill(12) for index in range(size)]
+    steps = ['pipeline'] if fused else ['copier', 'remediator']
+    latencies = {name: [] for name in ['launcher'] + steps + ['end_to_end']}
+    counter.reset()
+    started = time.perf_counter()
+    # handlers report progress with print, keep the benchmark output readable
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(run_account, handlers, account, latencies, fused) for account in accounts]:
+                future.result()
+    elapsed = time.perf_counter() - started
+    return {
+        'accounts': size,
+        'seconds': round(elapsed, 3),
+        'accounts_per_second': round(size / elapsed, 2),
+        'latency_ms': {
+            name: {
+                'p50': round(statistics.median(values), 2),
+                'p99': round(percentile(values, 0.99), 2)
+            }
+            for name, values in latencies.items()
+        },
+        'api_calls': dict(counter.calls),
+        'api_calls_per_account': round(sum(counter.calls.values()) / size, 2)
+    }
+
+def print_result(result):
+    print('{} accounts in {} s ({} accounts/s)'.format(result['accounts'], result['seconds'], result['accounts_per_second']))
+    for name, latency in result['latency_ms'].items():
+        print('  {:<12} p50 {:9.2f} ms  p99 {:9.2f} ms'.format(name, latency['p50'], latency['p99']))
+    print('  api calls    {} per account: {}'.format(
+        result['api_calls_per_account'],
+        ', '.join('{}={}'.format(service, count) for service, count in sorted(result['api_calls'].items()))))
+
+def load_baseline(path):
+    # burst size -> result, from the one-result-per-line output of --json
+    with open(path) as baseline_file:
+        results = [json.loads(line) for line in baseline_file if line.strip()]
+    return {result['accounts']: result for result in results}
+
+def compare_result(result, baseline, tolerance):
+    # latencies may grow by tolerance percent, API calls per account may not grow at all
+    regressions = []
+    for name, latency in result['latency_ms'].items():
+        if name not in baseline['latency_ms']:
+            continue
+        for key in ('p50', 'p99'):
+            limit = max(baseline['latency_ms'][name][key] * (1 + tolerance / 100),
+                baseline['latency_ms'][name][key] + LATENCY_NOISE_MS)
+            if latency[key] > limit:
+                regressions.append('{} accounts: {} {} {:.2f} ms, baseline {:.2f} ms'.format(
+                    result['accounts'], name, key, latency[key], baseline['latency_ms'][name][key]))
+    if result['api_calls_per_account'] > baseline['api_calls_per_account']:
+        regressions.append('{} accounts: {} api calls per account, baseline {}'.format(
+            result['accounts'], result['api_calls_per_account'], baseline['api_calls_per_account']))
+    return regressions
+
+def main():
+    args = parser.parse_args()
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+    regressions = []
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('bench_pipeline.py needs moto: pip install "moto[all]"')
+    os.environ.update(ENVIRONMENT)
+    if args.ledger:
+        os.environ['ledger_table'] = 'SHRemediationLedger'
+    import sh_clients
+    import sh_credentials
+    import sh_remediator_sm_launcher
+    import sh_ops_bucket
+    import sh_remediator
+    import sh_pipeline
+    handlers = (sh_remediator_sm_launcher, sh_ops_bucket, sh_remediator, sh_pipeline)
+    counter = ApiCounter()
+    sh_clients.client_hooks.append(counter.hook)
+    with mock_aws():
+        setup_master(sh_clients)
+        if args.ledger:
+            setup_ledger(sh_clients, os.environ['ledger_table'])
+        first_account = 200000000000
+        for size in [int(size) for size in args.bursts.split(',')]:
+            result = run_burst(handlers, size, args.workers, counter, first_account, args.fused)
+            first_account += size
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print_result(result)
+            if size in baseline:
+                regressions.extend(compare_result(result, baseline[size], args.tolerance))
+    if not args.json:
+        print('credential cache: {}'.format(sh_credentials.get_cache_stats()))
+    if regressions:
+        sys.exit('Regressed against {}:\n{}'.format(args.baseline, '\n'.join(regressions)))
+
+if __name__ == '__main__':
+    main()
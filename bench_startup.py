@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+
+# clients each handler builds on its first invocation
+HANDLERS = {
+    'sh_remediator_sm_launcher': ['stepfunctions', 'organizations'],
+    'sh_ops_bucket': ['sts', 's3', 'ssm', 'cloudformation'],
+    'sh_remediator': ['sts', 'cloudformation', 's3'],
+    'sh_pipeline': ['sts', 's3', 'ssm', 'cloudformation']
+}
+
+PROBE = '''
+import json, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+import sh_clients
+timings = {{'import': (imported - started) * 1000}}
+for service in {services!r}:
+    started = time.perf_counter()
+    sh_clients.get_client(service)
+    created = time.perf_counter()
+    sh_clients.get_client(service)
+    timings[service + ' first'] = (created - started) * 1000
+    timings[service + ' cached'] = (time.perf_counter() - created) * 1000
+print(json.dumps(timings))
+'''
+
+parser = argparse.ArgumentParser(description='Measure cold import and first client time of each handler')
+parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per handler')
+
+def probe_handler(module, services):
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    # every run is a new interpreter, like a Lambda cold start
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(module=module, services=services)],
+        cwd=SRC_DIR, env=env)
+    return json.loads(output)
+
+def main():
+    args = parser.parse_args()
+    for module, services in HANDLERS.items():
+        samples = [probe_handler(module, services) for run in range(args.runs)]
+        print(module)
+        for name in samples[0]:
+            values = [sample[name] for sample in samples]
+            print('  {:<28} median {:8.2f} ms  max {:8.2f} ms'.format(name, statistics.median(values), max(values)))
+
+if __name__ == '__main__':
+    main()
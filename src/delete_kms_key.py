@@ -1,11 +1,14 @@
 import os
 import sys
 import json
-import boto3
-import urllib3
+import fnmatch
 import logging
+import threading
+import sh_clients
+import sh_credentials
 import argparse
 from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -14,11 +17,25 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
-parser = argparse.ArgumentParser()
-parser.add_argument('account_id', help='Member account id')
-parser.add_argument('kms_key_alias', help='KMS key alias')
+parser = argparse.ArgumentParser(description='Delete KMS key aliases and schedule their keys for deletion')
+parser.add_argument('account_id', nargs='?', help='Member account id')
+parser.add_argument('kms_key_alias', nargs='?', help='KMS key alias')
+parser.add_argument('--org-id', default=os.environ.get('org_id', 'o-a4tlobvmc0'), help='Organization id, used as ExternalId')
+parser.add_argument('--role', default=os.environ.get('assume_role', 'AWSControlTowerExecution'), help='role assumed in each account')
+parser.add_argument('--accounts-file', help='file with one account id per line, - for stdin')
+parser.add_argument('--ou-id', help='every active account of this OU')
+parser.add_argument('--alias', action='append', default=[], help='alias to delete, may be repeated')
+parser.add_argument('--alias-pattern', help='glob of aliases to delete, e.g. alias/sh-remediation-*')
+parser.add_argument('--regions', help='comma separated regions, default is the session region')
+parser.add_argument('--workers', type=int, default=16, help='account and region pairs processed in parallel')
+parser.add_argument('--account-concurrency', type=int, default=2, help='regions of one account processed in parallel')
+parser.add_argument('--pending-days', type=int, default=7, help='waiting period before the keys are deleted')
+parser.add_argument('--dry-run', action='store_true', help='report the keys that would be deleted')
+parser.add_argument('--list', action='store_true', help='list the aliases instead of deleting')
 
-session = boto3.Session()
+_output_lock = threading.Lock()
+_account_locks = {}
+_lock = threading.Lock()
 
 def json_serial(obj):
     if isinstance(obj, (datetime, date)):
@@ -26,68 +43,121 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
+    role_session = sh_credentials.get_role_session(org_id, aws_account_number, role_name)
     LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+    return role_session['session']
 
-def list_kms_keys(member_session):
+def emit(result):
+    # one JSON document per line, safe to pipe into jq or a file
+    with _output_lock:
+        print(json.dumps(result, default=json_serial), flush=True)
+
+def get_alias_index(member_session, region=None):
+    # alias name -> target key id, built with one scan per account and region
+    alias_index = {}
     try:
-        kms_client = member_session.client('kms')
+        kms_client = sh_clients.get_client('kms', member_session, region)
         paginator = kms_client.get_paginator('list_aliases')
         iterator = paginator.paginate()
         for page in iterator:
             for alias in page['Aliases']:
-                print(json.dumps(alias, default=json_serial, indent=2))
+                if 'TargetKeyId' in alias and not alias['AliasName'].startswith('alias/aws/'):
+                    alias_index[alias['AliasName']] = alias['TargetKeyId']
     except Exception as e:
-        print(f'failed in list_aliases(..): {e}')
-        print(str(e))
+        print(f'failed in list_aliases(..): {e}', file=sys.stderr)
+        raise e
+    return alias_index
+
+def list_kms_keys(member_session, region=None):
+    for alias_name, key_id in sorted(get_alias_index(member_session, region).items()):
+        emit({'alias': alias_name, 'key_id': key_id})
+
+def match_aliases(alias_index, aliases, alias_pattern=None):
+    matched = [alias for alias in aliases if alias in alias_index]
+    if alias_pattern:
+        matched += [alias for alias in alias_index if fnmatch.fnmatchcase(alias, alias_pattern) and alias not in matched]
+    return matched
 
-def delete_kms_key(member_session, key_alias):
+def delete_kms_key(member_session, key_alias, region=None, alias_index=None, pending_days=7, dry_run=False, scheduled=None):
+    alias_index = get_alias_index(member_session, region) if alias_index is None else alias_index
+    key_id = alias_index.get(key_alias)
+    if key_id is None:
+        return {'alias': key_alias, 'action': 'not_found'}
+    print('Key Alias: {} with Key Id: {} found.'.format(key_alias, key_id), file=sys.stderr)
+    if dry_run:
+        return {'alias': key_alias, 'key_id': key_id, 'action': 'would_delete'}
     try:
-        kms_client = member_session.client('kms')
-        paginator = kms_client.get_paginator('list_aliases')
-        iterator = paginator.paginate()
-        for page in iterator:
-            for alias in page['Aliases']:
-                if alias['AliasName'] == key_alias:
-                    key_id = alias['TargetKeyId']
-                    print('Key Alias: {} with Key Id: {} found.'.format(key_alias, key_id))
-                    response = kms_client.delete_alias(
-                        AliasName=key_alias
-                    )
-                    print(json.dumps(response, default=json_serial, indent=2))
-                    response = kms_client.schedule_key_deletion(
-                        KeyId=key_id,
-                        PendingWindowInDays=7
-                    )
-                    print(json.dumps(response, default=json_serial, indent=2))
-                    break
+        kms_client = sh_clients.get_client('kms', member_session, region)
+        kms_client.delete_alias(AliasName=key_alias)
+        result = {'alias': key_alias, 'key_id': key_id, 'action': 'alias_deleted'}
+        # several aliases may point at the same key, it is scheduled once
+        if scheduled is None or key_id not in scheduled:
+            response = kms_client.schedule_key_deletion(
+                KeyId=key_id,
+                PendingWindowInDays=pending_days
+            )
+            if scheduled is not None:
+                scheduled.add(key_id)
+            result['action'] = 'deleted'
+            result['deletion_date'] = response['DeletionDate']
+        return result
     except Exception as e:
-        print(f'failed in schedule_key_deletion(..): {e}')
-        print(str(e))
+        print(f'failed in schedule_key_deletion(..): {e}', file=sys.stderr)
+        return {'alias': key_alias, 'key_id': key_id, 'action': 'error', 'error': str(e)}
+
+def account_lock(member_account, concurrency):
+    with _lock:
+        return _account_locks.setdefault(member_account, threading.BoundedSemaphore(concurrency))
+
+def clean_account_region(args, member_account, region):
+    base = {'account': member_account, 'region': region}
+    # bounds the load on one account's KMS endpoints and STS session
+    with account_lock(member_account, args.account_concurrency):
+        try:
+            member_session = assume_role(args.org_id, member_account, args.role)
+            alias_index = get_alias_index(member_session, region)
+        except Exception as e:
+            emit(dict(base, action='error', error=str(e)))
+            return
+        if args.list:
+            for alias_name, key_id in sorted(alias_index.items()):
+                emit(dict(base, alias=alias_name, key_id=key_id))
+            return
+        aliases = match_aliases(alias_index, args.alias, args.alias_pattern)
+        for alias in args.alias:
+            if alias not in alias_index:
+                emit(dict(base, alias=alias, action='not_found'))
+        scheduled = set()
+        for alias in aliases:
+            result = delete_kms_key(member_session, alias, region, alias_index, args.pending_days, args.dry_run, scheduled)
+            emit(dict(base, **result))
+
+def read_accounts(args):
+    accounts = []
+    if args.account_id:
+        accounts.append(args.account_id)
+    if args.accounts_file:
+        with (sys.stdin if args.accounts_file == '-' else open(args.accounts_file)) as accounts_file:
+            accounts.extend(line.strip() for line in accounts_file if line.strip() and not line.startswith('#'))
+    if args.ou_id:
+        org_client = sh_clients.get_client('organizations')
+        paginator = org_client.get_paginator('list_accounts_for_parent')
+        for page in paginator.paginate(ParentId=args.ou_id):
+            accounts.extend(account['Id'] for account in page['Accounts'] if account['Status'] == 'ACTIVE')
+    return list(dict.fromkeys(accounts))
 
 def main():
     args = parser.parse_args()
-    org_id = 'o-a4tlobvmc0'
-    role_name = 'AWSControlTowerExecution'
-    member_account = args.account_id
-    key_alias = args.kms_key_alias
-    member_session = assume_role(org_id, member_account, role_name)
-    delete_kms_key(member_session, key_alias)
+    if args.kms_key_alias:
+        args.alias.append(args.kms_key_alias)
+    accounts = read_accounts(args)
+    if not accounts or not (args.alias or args.alias_pattern or args.list):
+        parser.error('an account (id, --accounts-file or --ou-id) and an alias (--alias or --alias-pattern) are required')
+    regions = args.regions.split(',') if args.regions else [None]
+    tasks = [(member_account, region) for member_account in accounts for region in regions]
+    with ThreadPoolExecutor(max_workers=max(1, min(args.workers, len(tasks)))) as executor:
+        for future in [executor.submit(clean_account_region, args, member_account, region) for member_account, region in tasks]:
+            future.result()
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,10 @@
+#!/bin/bash
+SCRIPT_DIRECTORY="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+pushd $SCRIPT_DIRECTORY > /dev/null
+
+rm -rf .package sh_drift_scanner.zip
+
+zip sh_drift_scanner.zip sh_drift_scanner.py sh_remediator_sm_launcher.py sh_clients.py sh_credentials.py sh_ledger.py sh_metrics.py
+
+popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package sh_ops_bucket.zip
 
-zip sh_ops_bucket.zip sh_ops_bucket.py
+zip sh_ops_bucket.zip sh_ops_bucket.py sh_steps.py sh_clients.py sh_credentials.py sh_ledger.py sh_metrics.py
 
 popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package sh_remediator.zip
 
-zip sh_remediator.zip sh_remediator.py
+zip sh_remediator.zip sh_remediator.py sh_ops_bucket.py sh_pipeline.py sh_steps.py sh_clients.py sh_credentials.py sh_ledger.py sh_metrics.py
 
 popd > /dev/null
\ No newline at end of file
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package sh_remediator_sm_launcher.zip
 
-zip sh_remediator_sm_launcher.zip sh_remediator_sm_launcher.py
+zip sh_remediator_sm_launcher.zip sh_remediator_sm_launcher.py sh_dlq_redrive.py sh_clients.py sh_credentials.py sh_ledger.py sh_metrics.py
 
 popd > /dev/null
@@ -0,0 +1,107 @@
+import os
+import boto3
+import weakref
+import logging
+import functools
+import threading
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+# adaptive mode adds client-side rate limiting on top of jittered exponential backoff
+retry_mode = os.environ.get('retry_mode', 'adaptive')
+default_max_attempts = int(os.environ.get('retry_max_attempts', '6'))
+# cross-account control plane calls throttle first during enrollment waves
+service_max_attempts = {
+    'sts': 10,
+    'cloudformation': 10,
+    'organizations': 10,
+    'stepfunctions': 8
+}
+throttle_codes = (
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown', 'PriorRequestNotComplete'
+)
+
+class Throttling(Exception):
+    pass
+
+class TooManyRequests(Exception):
+    pass
+
+# built on first use and kept across warm invocations of the same container
+_default_session = None
+_clients = {}
+# sessions whose clients were evicted; threads still holding one get uncached clients
+_evicted_sessions = weakref.WeakSet()
+_lock = threading.Lock()
+# callables run on every newly created client, e.g. to register botocore event handlers
+client_hooks = []
+
+def get_default_session():
+    global _default_session
+    if _default_session is None:
+        with _lock:
+            if _default_session is None:
+                _default_session = boto3.Session()
+    return _default_session
+
+def get_retry_config(service):
+    max_attempts = os.environ.get('retry_max_attempts_{}'.format(service), service_max_attempts.get(service, default_max_attempts))
+    return Config(retries={
+        'mode': retry_mode,
+        'max_attempts': int(max_attempts)
+    })
+
+def get_client(service, session=None, region=None, **kwargs):
+    session = session or get_default_session()
+    key = (session, service, region, tuple(sorted(kwargs.items())))
+    client = _clients.get(key)
+    if client is None:
+        # boto3 sessions are not thread-safe when creating clients
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                if 'config' not in kwargs:
+                    kwargs['config'] = get_retry_config(service)
+                client = session.client(service, region_name=region, **kwargs)
+                for hook in client_hooks:
+                    hook(client)
+                if session in _evicted_sessions:
+                    return client
+                _clients[key] = client
+                LOGGER.info(f"Client created for {service} in {region or session.region_name}")
+    return client
+
+def evict_session(session):
+    with _lock:
+        _evicted_sessions.add(session)
+        for key in [key for key in _clients if key[0] is session]:
+            del _clients[key]
+
+def clear_clients():
+    global _default_session
+    with _lock:
+        _clients.clear()
+        _default_session = None
+
+def surface_throttling(handler):
+    # named errors let the state machine retry throttled steps with backoff
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code == 'TooManyRequestsException':
+                raise TooManyRequests(str(e)) from e
+            if error_code in throttle_codes:
+                raise Throttling(str(e)) from e
+            raise e
+    return wrapper
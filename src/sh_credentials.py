@@ -0,0 +1,132 @@
+import os
+import boto3
+import logging
+import threading
+import sh_clients
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+# assumed-role sessions are refreshed this many seconds before they expire
+refresh_margin = timedelta(seconds=int(os.environ.get('credential_refresh_margin', '300')))
+# sessions kept per container, each one holds its own clients and service models
+session_cache_size = int(os.environ.get('credential_cache_size', '8'))
+
+# module-level state survives across warm invocations of the same container
+_partition = None
+_role_sessions = OrderedDict()
+_key_locks = {}
+_lock = threading.Lock()
+cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'evictions': 0
+}
+
+def _count(name):
+    with _lock:
+        cache_stats[name] += 1
+
+def _key_lock(key):
+    with _lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+def _is_fresh(role_session):
+    return role_session['expiration'] - refresh_margin > datetime.now(timezone.utc)
+
+def get_partition():
+    global _partition
+    if _partition is None:
+        # roles assumed concurrently on a cold start resolve it once
+        with _key_lock('partition'):
+            if _partition is None:
+                sts_client = sh_clients.get_client('sts')
+                _partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
+                LOGGER.info(f"Partition resolved: {_partition}")
+    return _partition
+
+def _assume_role(org_id, aws_account_number, role_name):
+    try:
+        sts_client = sh_clients.get_client('sts')
+        response = sts_client.assume_role(
+            RoleArn='arn:%s:iam::%s:role/%s' % (
+                get_partition(), aws_account_number, role_name
+            ),
+            RoleSessionName=str(aws_account_number+'-'+role_name),
+            ExternalId=org_id
+        )
+    except Exception as e:
+        print(f'failed in assume_role(..): {e}')
+        print(str(e))
+        raise e
+    credentials = response['Credentials']
+    return {
+        'session': boto3.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']
+        ),
+        'role_arn': response['AssumedRoleUser']['Arn'],
+        'expiration': credentials['Expiration']
+    }
+
+def _cache_session(key, role_session):
+    with _lock:
+        _role_sessions[key] = role_session
+        _role_sessions.move_to_end(key)
+        evicted = []
+        while len(_role_sessions) > session_cache_size:
+            evicted.append(_role_sessions.popitem(last=False))
+        cache_stats['evictions'] += len(evicted)
+    for evicted_key, evicted_session in evicted:
+        # the clients of an evicted session would otherwise keep it alive
+        sh_clients.evict_session(evicted_session['session'])
+        LOGGER.info(f"Evicted cached session for Account {evicted_key[0]}")
+
+def get_role_session(org_id, aws_account_number, role_name, cache=True):
+    if not cache:
+        # for callers that visit each account once per run, where a cached session would only
+        # hold memory; they evict the session's clients themselves when done
+        _count('misses')
+        return _assume_role(org_id, aws_account_number, role_name)
+    key = (aws_account_number, role_name, org_id)
+    # one lock per key, so different accounts can be assumed concurrently
+    with _key_lock(key):
+        with _lock:
+            role_session = _role_sessions.get(key)
+            if role_session and _is_fresh(role_session):
+                cache_stats['hits'] += 1
+                _role_sessions.move_to_end(key)
+                LOGGER.info(f"Reusing cached session for Account {aws_account_number}")
+                return role_session
+        _count('refreshes' if role_session else 'misses')
+        fresh_session = _assume_role(org_id, aws_account_number, role_name)
+        if role_session:
+            # clients of the expiring session must not be reused
+            sh_clients.evict_session(role_session['session'])
+        _cache_session(key, fresh_session)
+        LOGGER.info(f"Cached session for Account {aws_account_number} until {fresh_session['expiration']}")
+        return fresh_session
+
+def get_cache_stats():
+    with _lock:
+        stats = dict(cache_stats)
+    stats['cached_sessions'] = len(_role_sessions)
+    return stats
+
+def clear_cache():
+    global _partition
+    with _lock:
+        sessions = list(_role_sessions.values())
+        _role_sessions.clear()
+        _key_locks.clear()
+        _partition = None
+    for role_session in sessions:
+        sh_clients.evict_session(role_session['session'])
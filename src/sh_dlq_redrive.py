@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+import sh_clients
+import sh_metrics
+import sh_remediator_sm_launcher
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+dlq_name = os.environ.get('dlq_name', 'SHEnablerEventDLQ')
+# received messages stay hidden for the whole pass, so none is read twice
+visibility_timeout = int(os.environ.get('redrive_visibility_timeout', '900'))
+receive_concurrency = int(os.environ.get('redrive_receive_concurrency', '4'))
+# executions started per second
+redrive_rate = float(os.environ.get('redrive_rate', '5'))
+# seconds of the invocation kept for deleting and releasing messages at the end of a pass
+redrive_time_margin = int(os.environ.get('redrive_time_margin', '30'))
+receive_wait_seconds = 20
+
+parser = argparse.ArgumentParser(description='Replay SecurityHubEnabled events from SHEnablerEventDLQ')
+parser.add_argument('--dry-run', action='store_true', help='summarize the queue without starting executions')
+parser.add_argument('--max-messages', type=int, default=0, help='stop after this many messages, 0 reads the whole queue')
+parser.add_argument('--rate', type=float, default=redrive_rate, help='executions started per second')
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_start = time.monotonic()
+
+    def wait(self):
+        delay = self.next_start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_start = max(self.next_start, time.monotonic()) + self.interval
+
+def get_queue_url(sqs_client):
+    if os.environ.get('dlq_url'):
+        return os.environ['dlq_url']
+    try:
+        return sqs_client.get_queue_url(QueueName=dlq_name)['QueueUrl']
+    except Exception as e:
+        print(f'failed in get_queue_url(..): {e}')
+        print(str(e))
+        raise e
+
+def has_time(deadline, seconds=0):
+    return deadline is None or time.monotonic() + seconds < deadline
+
+def receive_messages(sqs_client, queue_url, max_messages, deadline=None):
+    messages = []
+    lock = threading.Lock()
+
+    def receive():
+        # a receive may block for the whole long poll
+        while has_time(deadline, receive_wait_seconds):
+            with lock:
+                if max_messages and len(messages) >= max_messages:
+                    return
+            # long polling, an empty receive means the queue is drained
+            response = sqs_client.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=receive_wait_seconds,
+                VisibilityTimeout=visibility_timeout)
+            if not response.get('Messages'):
+                return
+            with lock:
+                messages.extend(response['Messages'])
+
+    try:
+        with ThreadPoolExecutor(max_workers=receive_concurrency) as executor:
+            for future in [executor.submit(receive) for worker in range(receive_concurrency)]:
+                future.result()
+    except Exception as e:
+        print(f'failed in receive_message(..): {e}')
+        print(str(e))
+        raise e
+    LOGGER.info(f"Received {len(messages)} Messages from {queue_url}")
+    return messages
+
+def group_by_account(messages):
+    # member_account -> member data and every message that carried it
+    members = {}
+    rejected = []
+    for message in messages:
+        try:
+            sh_event = json.loads(message['Body'])
+        except ValueError:
+            sh_event = None
+        member_data, reason = sh_remediator_sm_launcher.parse_sh_enabler_event(sh_event)
+        if member_data is None:
+            sh_remediator_sm_launcher.reject_event(sh_event, 'Message {}: {}'.format(message['MessageId'], reason))
+            rejected.append(message)
+            continue
+        member = members.setdefault(member_data['member_account'], {
+            'member_data': member_data,
+            'event_ids': [],
+            'messages': []
+        })
+        member['event_ids'].append(sh_remediator_sm_launcher.get_event_id(sh_event))
+        member['messages'].append(message)
+    return members, rejected
+
+def batches(entries, size=10):
+    for index in range(0, len(entries), size):
+        yield entries[index:index + size]
+
+def delete_messages(sqs_client, queue_url, messages):
+    failed = 0
+    for batch in batches(messages):
+        response = sqs_client.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']} for index, message in enumerate(batch)])
+        failed += len(response.get('Failed', []))
+    return failed
+
+def release_messages(sqs_client, queue_url, messages):
+    # make unhandled messages visible again instead of waiting for the timeout
+    for batch in batches(messages):
+        sqs_client.change_message_visibility_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle'], 'VisibilityTimeout': 0}
+                for index, message in enumerate(batch)])
+
+def get_deadline(context):
+    # None when run locally, where a pass has no time limit
+    if context is None:
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - redrive_time_margin
+
+def redrive(dry_run=False, max_messages=0, rate=redrive_rate, deadline=None):
+    sqs_client = sh_clients.get_client('sqs')
+    queue_url = get_queue_url(sqs_client)
+    messages = receive_messages(sqs_client, queue_url, max_messages, deadline)
+    members, rejected = group_by_account(messages)
+    summary = {
+        'messages': len(messages),
+        'accounts': len(members),
+        'rejected': len(rejected),
+        'started': [],
+        'failed': [],
+        'deleted': 0,
+        'deferred': 0,
+        'dry_run': dry_run
+    }
+    if dry_run:
+        unhandled = list(rejected)
+        summary['messages_per_account'] = {
+            member_account: len(member['messages']) for member_account, member in members.items()
+        }
+        for member in members.values():
+            unhandled.extend(member['messages'])
+    else:
+        # replaying a malformed event cannot succeed, so it leaves the queue instead of coming back every pass
+        unhandled = []
+        summary['deleted'] += len(rejected) - delete_messages(sqs_client, queue_url, rejected)
+        limiter = RateLimiter(rate)
+        for member_account, member in members.items():
+            if not has_time(deadline, limiter.interval):
+                # the next pass starts the rest
+                summary['deferred'] += 1
+                unhandled.extend(member['messages'])
+                continue
+            limiter.wait()
+            input = sh_remediator_sm_launcher.prepare_input({}, member['member_data'])
+            exec_name = sh_remediator_sm_launcher.execution_name(member_account, member['event_ids'][0])
+            try:
+                sh_remediator_sm_launcher.start_workflow(input, exec_name)
+            except Exception:
+                summary['failed'].append(member_account)
+                unhandled.extend(member['messages'])
+                continue
+            summary['started'].append(member_account)
+            # only the messages of accounts that were launched leave the queue
+            summary['deleted'] += len(member['messages']) - delete_messages(sqs_client, queue_url, member['messages'])
+    release_messages(sqs_client, queue_url, unhandled)
+    sh_metrics.put_metric('RedrivenMessages', summary['deleted'])
+    sh_metrics.put_metric('RedriveFailedAccounts', len(summary['failed']))
+    print('Redrive of {}: {} Messages for {} Accounts, {} deleted, {} rejected, {} Accounts failed, {} Accounts deferred'.format(
+        queue_url, summary['messages'], summary['accounts'], summary['deleted'], summary['rejected'], len(summary['failed']),
+        summary['deferred']))
+    return summary
+
+@sh_metrics.instrumented('SHEnablerEventDLQRedrive')
+@sh_clients.surface_throttling
+def lambda_handler(event, context):
+    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    return redrive(
+        dry_run=bool(event.get('dry_run', False)),
+        max_messages=int(event.get('max_messages', 0)),
+        rate=float(event.get('rate', redrive_rate)),
+        deadline=get_deadline(context))
+
+def main():
+    args = parser.parse_args()
+    summary = redrive(dry_run=args.dry_run, max_messages=args.max_messages, rate=args.rate)
+    print(json.dumps(summary, indent=2))
+
+if __name__ == '__main__':
+    main()
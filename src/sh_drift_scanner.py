@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import logging
+import sh_clients
+import sh_credentials
+import sh_ledger
+import sh_metrics
+import sh_remediator_sm_launcher
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+scan_concurrency = int(os.environ.get('scan_concurrency', '32'))
+# healthy stacks are not checked again for this many seconds
+scan_cache_ttl = timedelta(seconds=int(os.environ.get('scan_cache_ttl', '21600')))
+healthy_statuses = ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE')
+# account -> last stack check, kept across warm invocations and persisted in the ledger
+_stack_checks = {}
+
+def assume_role(org_id, aws_account_number, role_name):
+    role_session = sh_credentials.get_role_session(org_id, aws_account_number, role_name, cache=False)
+    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
+    return role_session['session']
+
+def load_stack_checks():
+    # one paginated scan instead of a read per account
+    for member_account, progress in sh_ledger.scan_progress('stack_health', 'stack_checked_at').items():
+        if 'stack_checked_at' in progress:
+            _stack_checks.setdefault(member_account, {
+                'stack_health': progress['stack_health'],
+                'checked_at': datetime.fromisoformat(progress['stack_checked_at'])
+            })
+
+def is_cached_healthy(member_account):
+    stack_check = _stack_checks.get(member_account)
+    if stack_check is None or stack_check['stack_health'] != 'HEALTHY':
+        return False
+    return stack_check['checked_at'] + scan_cache_ttl > datetime.now(timezone.utc)
+
+def get_stack_health(org_id, role_name, region, member_account):
+    member_session = assume_role(org_id, member_account, role_name)
+    try:
+        cfn_client = sh_clients.get_client('cloudformation', member_session, region)
+        try:
+            response = cfn_client.describe_stacks(StackName='SHRemediator-{}'.format(member_account))
+        except ClientError as e:
+            if 'does not exist' in e.response['Error']['Message']:
+                return 'MISSING'
+            raise e
+        stack_status = response['Stacks'][0]['StackStatus']
+        if stack_status in healthy_statuses:
+            return 'HEALTHY'
+        if stack_status.endswith('_IN_PROGRESS'):
+            return 'IN_PROGRESS'
+        return 'UNHEALTHY'
+    finally:
+        sh_clients.evict_session(member_session)
+
+def check_account(org_id, role_name, region, account):
+    member_account = account['member_account']
+    try:
+        stack_health = get_stack_health(org_id, role_name, region, member_account)
+    except Exception as e:
+        # e.g. an account the role cannot be assumed in, left out of this scan
+        print(f'failed in describe_stacks(..) for Account {member_account}: {e}')
+        return 'ERROR'
+    checked_at = datetime.now(timezone.utc)
+    _stack_checks[member_account] = {
+        'stack_health': stack_health,
+        'checked_at': checked_at
+    }
+    sh_ledger.update(member_account, stack_health=stack_health, stack_checked_at=checked_at.isoformat())
+    return stack_health
+
+def scan(event):
+    org_id = os.environ['org_id']
+    role_name = os.environ['assume_role']
+    home_region = os.environ['home_region']
+    excluded = set(filter(None, os.environ.get('exclude_accounts', '').split(',')))
+    excluded.add(os.environ['master_account'])
+    started = time.perf_counter()
+    accounts = sh_remediator_sm_launcher.list_org_accounts(excluded)
+    if event.get('force'):
+        _stack_checks.clear()
+    elif not _stack_checks:
+        load_stack_checks()
+    pending = [account for account in accounts if not is_cached_healthy(account['member_account'])]
+    LOGGER.info(f"{len(accounts) - len(pending)} Accounts healthy from cache, checking {len(pending)}")
+    results = {}
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(len(pending), scan_concurrency)) as executor:
+            health = executor.map(lambda account: check_account(org_id, role_name, home_region, account), pending)
+            for account, stack_health in zip(pending, health):
+                results[account['member_account']] = stack_health
+    missing = [account for account in pending if results[account['member_account']] in ('MISSING', 'UNHEALTHY')]
+    summary = {
+        'accounts': len(accounts),
+        'cached': len(accounts) - len(pending),
+        'checked': len(pending),
+        'missing': [account['member_account'] for account in missing],
+        'in_progress': [account for account, health in results.items() if health == 'IN_PROGRESS'],
+        'errors': [account for account, health in results.items() if health == 'ERROR'],
+        'execution_arns': []
+    }
+    if missing and not event.get('dry_run'):
+        # the same drift found by a retried invocation maps to the same executions
+        summary['execution_arns'] = sh_remediator_sm_launcher.start_bulk_workflows(
+            event, missing, datetime.now(timezone.utc).strftime('%Y%m%d%H'))
+    elapsed = time.perf_counter() - started
+    sh_metrics.put_metric('ScannedAccounts', len(accounts))
+    sh_metrics.put_metric('CheckedAccounts', len(pending))
+    sh_metrics.put_metric('DriftedAccounts', len(missing))
+    sh_metrics.put_metric('ScanTime', elapsed * 1000, 'Milliseconds')
+    print('Scanned {} Accounts in {:.1f} s: {} checked, {} to remediate'.format(
+        len(accounts), elapsed, len(pending), len(missing)))
+    return summary
+
+@sh_metrics.instrumented('SHRemediationDriftScanner')
+@sh_clients.surface_throttling
+def lambda_handler(event, context):
+    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    return scan(event)
@@ -0,0 +1,198 @@
+import os
+import logging
+import sh_clients
+from decimal import Decimal
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+# progress of every Member Account, keyed by member_account; disabled when no table is configured
+table_name = os.environ.get('ledger_table', '')
+# e.g. http://localhost:8000 for DynamoDB Local
+endpoint_url = os.environ.get('ledger_endpoint_url')
+status_index = 'status-index'
+# pipeline steps in the order they run
+steps = ('bucket', 'template', 'stack')
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+def enabled():
+    return bool(table_name)
+
+def get_ddb_client():
+    if endpoint_url:
+        return sh_clients.get_client('dynamodb', endpoint_url=endpoint_url)
+    return sh_clients.get_client('dynamodb')
+
+def _plain(value):
+    # handler responses are serialized to JSON, which has no Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, set)):
+        return [_plain(item) for item in value]
+    return value
+
+def get_progress(member_account):
+    if not enabled():
+        return {}
+    try:
+        response = get_ddb_client().get_item(
+            TableName=table_name,
+            Key={'member_account': {'S': member_account}},
+            ConsistentRead=True)
+    except Exception as e:
+        print(f'failed in get_item(..): {e}')
+        print(str(e))
+        raise e
+    item = response.get('Item', {})
+    return _plain({key: _deserializer.deserialize(value) for key, value in item.items()})
+
+def step_done(progress, step):
+    return progress.get('{}_step'.format(step)) == 'DONE'
+
+def record_step(member_account, step, step_status='DONE', status='IN_PROGRESS', **attributes):
+    attributes['{}_step'.format(step)] = step_status
+    return set_status(member_account, status, **attributes)
+
+def set_status(member_account, status, **attributes):
+    update(member_account, status=status, **attributes)
+    LOGGER.info(f"Ledger: Account {member_account} is {status}")
+
+def reset_steps(member_account, *reset):
+    # the next run repeats steps whose output has disappeared
+    update(member_account, **{'{}_step'.format(step): 'PENDING' for step in reset})
+    LOGGER.info(f"Ledger: Account {member_account} steps reset: {', '.join(reset)}")
+
+def update(member_account, **attributes):
+    if not enabled():
+        return
+    attributes['updated_at'] = datetime.now(timezone.utc).isoformat()
+    names = {}
+    values = {}
+    assignments = []
+    for index, (name, value) in enumerate(sorted(attributes.items())):
+        names['#a{}'.format(index)] = name
+        values[':v{}'.format(index)] = _serializer.serialize(value)
+        assignments.append('#a{0} = :v{0}'.format(index))
+    try:
+        get_ddb_client().update_item(
+            TableName=table_name,
+            Key={'member_account': {'S': member_account}},
+            UpdateExpression='SET ' + ', '.join(assignments),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values)
+    except Exception as e:
+        print(f'failed in update_item(..): {e}')
+        print(str(e))
+        raise e
+
+def claim(member_account, owner, replaced_owner=None):
+    # conditional write, so two executions never remediate the same account at once;
+    # returns None once owner holds the account, else the execution holding it
+    if not enabled():
+        return None
+    condition = 'attribute_not_exists(#owner) OR #owner = :owner'
+    values = {
+        ':owner': {'S': owner},
+        ':updated_at': {'S': datetime.now(timezone.utc).isoformat()}
+    }
+    if replaced_owner:
+        condition += ' OR #owner = :replaced_owner'
+        values[':replaced_owner'] = {'S': replaced_owner}
+    try:
+        get_ddb_client().update_item(
+            TableName=table_name,
+            Key={'member_account': {'S': member_account}},
+            UpdateExpression='SET #owner = :owner, #updated_at = :updated_at',
+            ConditionExpression=condition,
+            ExpressionAttributeNames={'#owner': 'claimed_by', '#updated_at': 'updated_at'},
+            ExpressionAttributeValues=values,
+            ReturnValuesOnConditionCheckFailure='ALL_OLD')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f'failed in update_item(..): {e}')
+            print(str(e))
+            raise e
+        return e.response.get('Item', {}).get('claimed_by', {}).get('S', '')
+    LOGGER.info(f"Ledger: Account {member_account} claimed by {owner}")
+    return None
+
+def release(member_account, owner):
+    # only the execution holding the account may release it, a newer claim is kept
+    if not enabled() or not owner:
+        return
+    try:
+        get_ddb_client().update_item(
+            TableName=table_name,
+            Key={'member_account': {'S': member_account}},
+            UpdateExpression='REMOVE #owner',
+            ConditionExpression='#owner = :owner',
+            ExpressionAttributeNames={'#owner': 'claimed_by'},
+            ExpressionAttributeValues={':owner': {'S': owner}})
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f'failed in update_item(..): {e}')
+            print(str(e))
+            raise e
+        LOGGER.info(f"Ledger: Account {member_account} no longer claimed by {owner}")
+        return
+    LOGGER.info(f"Ledger: Account {member_account} released by {owner}")
+
+def scan_progress(*attributes):
+    # selected attributes of every account, for jobs that look at the whole organization
+    if not enabled():
+        return {}
+    names = {'#a{}'.format(index): name for index, name in enumerate(('member_account',) + attributes)}
+    progress = {}
+    try:
+        paginator = get_ddb_client().get_paginator('scan')
+        iterator = paginator.paginate(
+            TableName=table_name,
+            ProjectionExpression=', '.join(names),
+            ExpressionAttributeNames=names)
+        for page in iterator:
+            for item in page['Items']:
+                item = _plain({key: _deserializer.deserialize(value) for key, value in item.items()})
+                progress[item['member_account']] = item
+    except Exception as e:
+        print(f'failed in scan(..): {e}')
+        print(str(e))
+        raise e
+    return progress
+
+def list_accounts(status):
+    # served by the status index, no table scan
+    if not enabled():
+        return []
+    accounts = []
+    try:
+        paginator = get_ddb_client().get_paginator('query')
+        iterator = paginator.paginate(
+            TableName=table_name,
+            IndexName=status_index,
+            KeyConditionExpression='#status = :status',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':status': {'S': status}},
+            ProjectionExpression='member_account')
+        for page in iterator:
+            for item in page['Items']:
+                accounts.append(item['member_account']['S'])
+    except Exception as e:
+        print(f'failed in query(..): {e}')
+        print(str(e))
+        raise e
+    return accounts
+
+def list_pending_accounts():
+    # accounts the ledger has seen but that are not remediated yet
+    return list_accounts('IN_PROGRESS') + list_accounts('FAILED')
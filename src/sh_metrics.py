@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import logging
+import functools
+import threading
+import sh_clients
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+namespace = os.environ.get('metrics_namespace', 'SHRemediation')
+# EMF accepts at most 100 values per metric
+max_values = 100
+
+# state of the current invocation, flushed once at its end
+_lock = threading.Lock()
+_dimensions = {}
+_operations = {}
+_metrics = []
+
+def _operation(model):
+    key = (model.service_model.service_name, model.name)
+    with _lock:
+        return _operations.setdefault(key, {
+            'latency': [],
+            'calls': 0,
+            'retries': 0,
+            'throttles': 0,
+            'errors': 0
+        })
+
+def _before_call(model, context, **kwargs):
+    context['sh_metrics_started'] = time.perf_counter()
+    # after-call-error is not given the operation model
+    context['sh_metrics_model'] = model
+
+def _after_call(model, parsed, context, **kwargs):
+    elapsed = (time.perf_counter() - context.get('sh_metrics_started', time.perf_counter())) * 1000
+    operation = _operation(model)
+    error_code = parsed.get('Error', {}).get('Code')
+    with _lock:
+        operation['calls'] += 1
+        operation['latency'].append(elapsed)
+        operation['retries'] += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if error_code:
+            operation['errors'] += 1
+
+def _after_call_error(context, **kwargs):
+    if 'sh_metrics_model' not in context:
+        return
+    elapsed = (time.perf_counter() - context.get('sh_metrics_started', time.perf_counter())) * 1000
+    operation = _operation(context['sh_metrics_model'])
+    with _lock:
+        operation['calls'] += 1
+        operation['latency'].append(elapsed)
+        operation['errors'] += 1
+
+def _needs_retry(response, operation, **kwargs):
+    # called for every attempt, so throttles that were retried away are counted too
+    if response is None:
+        return None
+    error_code = response[1].get('Error', {}).get('Code')
+    if error_code in sh_clients.throttle_codes:
+        metrics = _operation(operation)
+        with _lock:
+            metrics['throttles'] += 1
+    return None
+
+def instrument_client(client):
+    client.meta.events.register('before-call', _before_call)
+    client.meta.events.register('after-call', _after_call)
+    client.meta.events.register('after-call-error', _after_call_error)
+    client.meta.events.register('needs-retry', _needs_retry)
+
+def set_dimension(name, value):
+    with _lock:
+        _dimensions[name] = str(value)
+
+def put_metric(name, value, unit='Count', **dimensions):
+    with _lock:
+        _metrics.append((name, value, unit, dimensions))
+
+def _document(metrics, properties, dimensions):
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': dimensions,
+                'Metrics': [{'Name': name, 'Unit': unit} for name, unit in metrics]
+            }]
+        }
+    }
+    document.update(properties)
+    return document
+
+def flush():
+    with _lock:
+        dimensions = dict(_dimensions)
+        operations = dict(_operations)
+        metrics = list(_metrics)
+        _operations.clear()
+        _metrics.clear()
+    documents = []
+    for (service, operation_name), operation in sorted(operations.items()):
+        properties = dict(dimensions, Service=service, Operation=operation_name)
+        properties.update({
+            'ApiLatency': [round(value, 2) for value in operation['latency'][:max_values]],
+            'ApiCalls': operation['calls'],
+            'ApiRetries': operation['retries'],
+            'ApiThrottles': operation['throttles'],
+            'ApiErrors': operation['errors']
+        })
+        documents.append(_document(
+            [('ApiLatency', 'Milliseconds'), ('ApiCalls', 'Count'), ('ApiRetries', 'Count'),
+                ('ApiThrottles', 'Count'), ('ApiErrors', 'Count')],
+            properties,
+            [['Handler', 'Service', 'Operation'], ['Handler', 'MemberAccount']]))
+    for name, value, unit, metric_dimensions in metrics:
+        properties = dict(dimensions, **metric_dimensions)
+        properties[name] = value
+        documents.append(_document([(name, unit)], properties, [['Handler'] + list(metric_dimensions)]))
+    # one write per invocation keeps the logging overhead negligible
+    if documents:
+        print('\n'.join(json.dumps(document) for document in documents))
+
+def instrumented(handler_name):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            with _lock:
+                _dimensions.clear()
+            set_dimension('Handler', handler_name)
+            set_dimension('MemberAccount', event.get('member_account', 'none') if isinstance(event, dict) else 'none')
+            try:
+                return handler(event, context)
+            finally:
+                flush()
+        return wrapper
+    return decorator
+
+# every client built through the registry is instrumented
+sh_clients.client_hooks.append(instrument_client)
@@ -1,10 +1,20 @@
 import os
-import sys
+import io
 import json
-import boto3
-import urllib3
+import uuid
+import shutil
 import logging
+import tempfile
+import threading
+import sh_clients
+import sh_credentials
+import sh_ledger
+import sh_metrics
+import sh_steps
+from collections import OrderedDict
 from datetime import date, datetime
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -13,7 +23,27 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
-session = boto3.Session()
+# SSM parameter on the Member Account that records its ops bucket
+bucket_parameter = os.environ.get('bucket_parameter', '/sh-remediation/member-bucket')
+# (member account, bucket) pairs known to exist in that account, kept across warm invocations
+_known_buckets = set()
+# names tried before a bucket creation gives up, a name taken by another account is replaced
+bucket_name_attempts = 3
+# bucket -> content-addressed template keys it is known to hold
+_template_manifest = {}
+# account -> Control Tower governed regions
+_ct_regions = {}
+# staged template bodies held in memory, in bytes
+template_cache_bytes = int(os.environ.get('template_cache_bytes', str(32 * 1024 * 1024)))
+# larger templates are spooled to /tmp instead of memory, and uploaded in parts
+template_spool_bytes = int(os.environ.get('template_spool_bytes', str(8 * 1024 * 1024)))
+transfer_config = TransferConfig(
+    multipart_threshold=template_spool_bytes,
+    max_concurrency=int(os.environ.get('template_upload_concurrency', '8')))
+# (bucket, key, etag) -> staged template, least recently used first
+_staged_templates = OrderedDict()
+_stage_locks = {}
+_lock = threading.Lock()
 
 def json_serial(obj):
     if isinstance(obj, (datetime, date)):
@@ -21,64 +51,133 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
+    role_session = sh_credentials.get_role_session(org_id, aws_account_number, role_name)
     LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+    return role_session['session']
 
-def create_bucket_if_not_exists(member_session, bucket_name):
+def get_bucket_prefix(member_bucket, member_account):
+    # bucket names are global, so every Member Account gets its own prefix
+    if '{account}' in member_bucket:
+        return member_bucket.format(account=member_account)
+    if member_account in member_bucket:
+        return member_bucket
+    return '{}-{}'.format(member_bucket, member_account)
+
+def bucket_exists(s3_client, bucket_name, member_account=None):
+    # single HEAD request instead of scanning list_buckets;
+    # None when the name is taken by a bucket of another account
+    head_args = {'ExpectedBucketOwner': member_account} if member_account else {}
+    try:
+        s3_client.head_bucket(Bucket=bucket_name, **head_args)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchBucket'):
+            return False
+        if e.response['Error']['Code'] in ('403', 'AccessDenied', 'Forbidden'):
+            return None
+        raise e
+
+def create_bucket_if_not_exists(member_session, bucket_name, block_public_access=True, member_account=None):
+    # False when the name belongs to another account and a new one has to be picked
+    if (member_account, bucket_name) in _known_buckets:
+        return True
     bucket_found = False
     try:
-        s3_client = member_session.client('s3')
-        response = s3_client.list_buckets()
-        for bucket in response['Buckets']:
-            if bucket['Name'] == bucket_name:
-                bucket_found = True
-                break
+        s3_client = sh_clients.get_client('s3', member_session)
+        bucket_found = bucket_exists(s3_client, bucket_name, member_account)
     except Exception as e:
-        print(f'failed in list_buckets(..): {e}')
+        print(f'failed in head_bucket(..): {e}')
         print(str(e))
         raise e
+    if bucket_found is None:
+        print('Bucket: {} belongs to another account.'.format(bucket_name))
+        return False
     if not bucket_found:
         print('Bucket: {} not found. Create it.'.format(bucket_name))
-        public_access_block = {
-            'BlockPublicAcls': True,
-            'IgnorePublicAcls': True,
-            'BlockPublicPolicy': True,
-            'RestrictPublicBuckets': True
-        }
         try:
-            s3_client = member_session.client('s3')
+            s3_client = sh_clients.get_client('s3', member_session)
             response = s3_client.create_bucket(
                 ACL='private',
                 Bucket=bucket_name,
                 ObjectOwnership='BucketOwnerPreferred')
             print('Bucket: {} created at Location: {}'.format(bucket_name, response['Location']))
-            s3_client.put_public_access_block(
-                Bucket=bucket_name,
-                PublicAccessBlockConfiguration=public_access_block
-            )
-            print('Public Access Blocked for Bucket: {}.'.format(bucket_name))
+            if block_public_access:
+                put_public_access_block(member_session, bucket_name)
             bucket_found = True
             print('Bucket: {} created.'.format(bucket_name))
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'BucketAlreadyExists':
+                # taken by another account between the HEAD and the create
+                print('Bucket: {} belongs to another account.'.format(bucket_name))
+                return False
+            print(f'failed in create_bucket(..): {e}')
+            print(str(e))
+            raise e
         except Exception as e:
             print(f'failed in create_bucket(..): {e}')
             print(str(e))
             raise e
+    if bucket_found:
+        _known_buckets.add((member_account, bucket_name))
     return bucket_found
 
+def put_public_access_block(member_session, bucket_name):
+    public_access_block = {
+        'BlockPublicAcls': True,
+        'IgnorePublicAcls': True,
+        'BlockPublicPolicy': True,
+        'RestrictPublicBuckets': True
+    }
+    try:
+        s3_client = sh_clients.get_client('s3', member_session)
+        s3_client.put_public_access_block(
+            Bucket=bucket_name,
+            PublicAccessBlockConfiguration=public_access_block
+        )
+        print('Public Access Blocked for Bucket: {}.'.format(bucket_name))
+    except Exception as e:
+        print(f'failed in put_public_access_block(..): {e}')
+        print(str(e))
+        raise e
+
+def read_bucket_index(member_session, region):
+    try:
+        ssm_client = sh_clients.get_client('ssm', member_session, region)
+        response = ssm_client.get_parameter(Name=bucket_parameter)
+        return response['Parameter']['Value']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ParameterNotFound':
+            return None
+        print(f'failed in get_parameter(..): {e}')
+        print(str(e))
+        raise e
+
+def get_indexed_bucket(member_session, member_account, region, bucket_prefix):
+    bucket_name = read_bucket_index(member_session, region)
+    # ignore buckets created for a different member_bucket prefix
+    if bucket_name is None or not bucket_name.startswith(bucket_prefix):
+        return None
+    s3_client = sh_clients.get_client('s3', member_session)
+    if (member_account, bucket_name) not in _known_buckets and not bucket_exists(s3_client, bucket_name, member_account):
+        return None
+    _known_buckets.add((member_account, bucket_name))
+    return bucket_name
+
+def index_bucket(member_session, region, bucket_name):
+    try:
+        ssm_client = sh_clients.get_client('ssm', member_session, region)
+        ssm_client.put_parameter(
+            Name=bucket_parameter,
+            Description='SecurityHub Remediation ops bucket',
+            Value=bucket_name,
+            Type='String',
+            Overwrite=True)
+        print('Bucket: {} indexed in Parameter: {}'.format(bucket_name, bucket_parameter))
+    except Exception as e:
+        print(f'failed in put_parameter(..): {e}')
+        print(str(e))
+        raise e
+
 def create_cross_account_bucket_policy(member_session, member_account, master_account, sh_role_name, bucket_name):
     bucket_policy = {
         'Version': '2012-10-17',
@@ -118,7 +217,7 @@ def create_cross_account_bucket_policy(member_session, member_account, master_ac
         ]
     }
     try:
-        s3_client = member_session.client('s3')
+        s3_client = sh_clients.get_client('s3', member_session)
         s3_client.put_bucket_policy(
             Bucket=bucket_name,
             Policy=json.dumps(bucket_policy)
@@ -129,49 +228,152 @@ def create_cross_account_bucket_policy(member_session, member_account, master_ac
         print(str(e))
         raise e
 
-def upload_template(master_session, bucket_name, cfn_template_name):
+def upload_template(master_session, bucket_name, cfn_template_name, target_key=None, source_bucket='org-sh-ops', template_hash=None):
+    # the master object is read once per version, every upload streams the staged copy
+    body = download_template(master_session, cfn_template_name, source_bucket, template_hash)
     try:
-        s3_client = master_session.client('s3')
-        with open('./test.yaml', 'rb') as r:
-            s3_client.upload_fileobj(r, bucket_name, cfn_template_name)
-        r.close()
+        s3_client = sh_clients.get_client('s3', master_session)
+        with body:
+            s3_client.upload_fileobj(
+                body,
+                bucket_name,
+                target_key or cfn_template_name,
+                ExtraArgs={'ACL': 'bucket-owner-full-control'},
+                Config=transfer_config)
+        print('CFN Template: {} uploaded to Bucket: {}'.format(cfn_template_name, bucket_name))
     except Exception as e:
         print(f'failed in upload_fileobj(..): {e}')
         print(str(e))
         raise e
 
-def download_template(master_session, cfn_template_name):
+def download_template(master_session, cfn_template_name, source_bucket='org-sh-ops', template_hash=None):
+    template_hash = template_hash or get_template_hash(master_session, source_bucket, cfn_template_name)
+    cache_key = (source_bucket, cfn_template_name, template_hash)
+    with _lock:
+        stage_lock = _stage_locks.setdefault(cache_key, threading.Lock())
+    # buckets filled in parallel wait for the first download instead of repeating it
+    with stage_lock:
+        with _lock:
+            if cache_key in _staged_templates:
+                _staged_templates.move_to_end(cache_key)
+                return open_staged(_staged_templates[cache_key])
+        staged = stage_template(master_session, source_bucket, cfn_template_name, template_hash)
+        with _lock:
+            # an older version of the same template is not needed anymore
+            for stale_key in [key for key in _staged_templates if key[:2] == cache_key[:2]]:
+                drop_staged(stale_key)
+            _staged_templates[cache_key] = staged
+            evict_staged()
+            return open_staged(staged)
+
+def stage_template(master_session, source_bucket, cfn_template_name, template_hash):
     try:
-        s3_client = master_session.client('s3')
-        with open('test.yaml', 'wb') as t:
-            s3_client.download_fileobj('org-sh-ops', cfn_template_name, t)
-        t.close()
+        s3_client = sh_clients.get_client('s3', master_session)
+        # IfMatch pins the body to the version the content-addressed key names
+        response = s3_client.get_object(Bucket=source_bucket, Key=cfn_template_name, IfMatch='"{}"'.format(template_hash))
+        if response['ContentLength'] <= template_spool_bytes:
+            return {'body': response['Body'].read(), 'path': None, 'size': response['ContentLength']}
+        with tempfile.NamedTemporaryFile(prefix='sh-template-', delete=False) as spool:
+            shutil.copyfileobj(response['Body'], spool)
+        LOGGER.info(f"CFN Template: {cfn_template_name} spooled to {spool.name}")
+        return {'body': None, 'path': spool.name, 'size': response['ContentLength']}
     except Exception as e:
-        print(f'failed in download_fileobj(..): {e}')
+        print(f'failed in get_object(..): {e}')
         print(str(e))
         raise e
 
-def copy_template(master_session, source_bucket, target_bucket, cfn_template_name):
+def open_staged(staged):
+    # every caller reads its own handle, an evicted spool file stays readable until closed
+    if staged['path']:
+        return open(staged['path'], 'rb')
+    return io.BytesIO(staged['body'])
+
+def drop_staged(cache_key):
+    staged = _staged_templates.pop(cache_key)
+    if staged['path'] and os.path.exists(staged['path']):
+        os.remove(staged['path'])
+
+def evict_staged():
+    in_memory = sum(staged['size'] for staged in _staged_templates.values() if staged['body'] is not None)
+    for cache_key in list(_staged_templates)[:-1]:
+        if in_memory <= template_cache_bytes:
+            break
+        if _staged_templates[cache_key]['body'] is not None:
+            in_memory -= _staged_templates[cache_key]['size']
+            drop_staged(cache_key)
+
+def copy_template(master_session, source_bucket, target_bucket, cfn_template_name, target_key=None, template_hash=None):
     try:
         source_bucket = {
             'Bucket': source_bucket,
             'Key': cfn_template_name
         }
-        s3_client = master_session.client('s3')
+        copy_args = {}
+        if template_hash:
+            # the content-addressed key must hold the version it names
+            copy_args['CopySourceIfMatch'] = '"{}"'.format(template_hash)
+        s3_client = sh_clients.get_client('s3', master_session)
         s3_client.copy_object(
             ACL='bucket-owner-full-control',
             Bucket=target_bucket,
             CopySource=source_bucket,
-            Key=cfn_template_name)
+            Key=target_key or cfn_template_name,
+            **copy_args)
         print('CFN Template: {} copied to Bucket: {}'.format(cfn_template_name, target_bucket))
     except Exception as e:
         print(f'failed in copy_object(..): {e}')
         print(str(e))
         raise e
 
+def get_template_hash(master_session, source_bucket, cfn_template_name):
+    try:
+        s3_client = sh_clients.get_client('s3', master_session)
+        response = s3_client.head_object(Bucket=source_bucket, Key=cfn_template_name)
+        return response['ETag'].strip('"')
+    except Exception as e:
+        print(f'failed in head_object(..): {e}')
+        print(str(e))
+        raise e
+
+def get_template_key(template_hash, cfn_template_name):
+    return 'templates/{}/{}'.format(template_hash, cfn_template_name)
+
+def template_exists(member_session, bucket_name, template_key):
+    if template_key in _template_manifest.get(bucket_name, set()):
+        return True
+    try:
+        # the Member Account owns the copied objects
+        s3_client = sh_clients.get_client('s3', member_session)
+        s3_client.head_object(Bucket=bucket_name, Key=template_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        print(f'failed in head_object(..): {e}')
+        print(str(e))
+        raise e
+    _template_manifest.setdefault(bucket_name, set()).add(template_key)
+    return True
+
+def distribute_template(master_session, member_session, source_bucket, target_bucket, cfn_template_name, template_hash=None, staged=False):
+    template_hash = template_hash or get_template_hash(master_session, source_bucket, cfn_template_name)
+    template_key = get_template_key(template_hash, cfn_template_name)
+    if template_exists(member_session, target_bucket, template_key):
+        print('CFN Template: {} unchanged in Bucket: {}. Copy skipped.'.format(template_key, target_bucket))
+    elif staged:
+        # one container filling many buckets reads the master object once
+        upload_template(master_session, target_bucket, cfn_template_name, template_key, source_bucket, template_hash)
+    else:
+        # a single bucket is filled by a server-side copy, the body never passes through Lambda
+        copy_template(master_session, source_bucket, target_bucket, cfn_template_name, template_key, template_hash)
+        _template_manifest.setdefault(target_bucket, set()).add(template_key)
+    return template_key, template_hash
+
 def get_ct_regions(account_id):
+    # governed regions rarely change, resolve them once per container
+    if account_id in _ct_regions:
+        return _ct_regions[account_id]
     # use CT session
-    cf_client = session.client('cloudformation')
+    cf_client = sh_clients.get_client('cloudformation')
     region_set = set()
     try:
         # stack instances are outdated
@@ -185,7 +387,18 @@ def get_ct_regions(account_id):
         LOGGER.warning("Control Tower StackSet not found in this Region")
         LOGGER.warning(str(ex))
     LOGGER.info(f"Control Tower Regions: {list(region_set)}")
-    return list(region_set)
+    if region_set:
+        _ct_regions[account_id] = sorted(region_set)
+    return sorted(region_set)
+
+def get_member_regions(event):
+    home_region = event['home_region']
+    # by default the CloudFormation stack is launched in home_region only
+    # Because aws-controltower/CloudTrailLogs is in Home Region of Member Account
+    multi_region = str(event.get('multi_region', os.environ.get('multi_region', 'false'))).lower() == 'true'
+    if not multi_region:
+        return [home_region]
+    return [home_region] + [region for region in get_ct_regions(event['sh_admin_account']) if region != home_region]
 
 #def main():
 #    org_id = 'o-a4tlobvmc0'
@@ -204,8 +417,7 @@ def get_ct_regions(account_id):
     #download_template(master_session, cfn_template_name)
     #upload_template(master_session, bucket_name, cfn_template_name)
     
-def lambda_handler(event, context):
-    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+def prepare_member_bucket(event, progress=None):
     org_id = event['org_id']
     role_name = event['assume_role']
     master_account = event['master_account']
@@ -213,22 +425,103 @@ def lambda_handler(event, context):
     master_bucket = event['master_bucket']
     member_account = event['member_account']
     member_email = event['member_email']
-    sh_admin_account = event['sh_admin_account']
-    member_bucket = event['member_bucket']
-    member_bucket = '{}-{}'.format(member_bucket, datetime.strftime(datetime.now(), '%Y%m%d%H%M%S'))
+    member_bucket_prefix = get_bucket_prefix(event['member_bucket'], member_account)
+    reuse_bucket = str(event.get('reuse_bucket', os.environ.get('reuse_bucket', 'true'))).lower() == 'true'
     cfn_template_name = event['cfn_template_name']
-    # not required to launch CloudFormation stack in all CT-governed regions on Member Account
-    # Run in home_region
-    # Because aws-controltower/CloudTrailLogs is in Home Region of Member Account
-    #sh_regions = get_ct_regions(sh_admin_account)
-    master_session = assume_role(org_id, master_account, role_name)
-    member_session = assume_role(org_id, member_account, role_name)
-    create_bucket_if_not_exists(member_session, member_bucket)
-    create_cross_account_bucket_policy(member_session, member_account, master_account, role_name, member_bucket)
-    copy_template(master_session, master_bucket, member_bucket, cfn_template_name)
-    #sh_ops_regions = []
-    #for region in sh_regions:
-    #    sh_ops_regions.append({
+
+    def get_ledger_bucket(results):
+        # steps recorded in the ledger by an earlier run are not repeated
+        ledger_progress = results['progress']
+        if not (reuse_bucket and sh_ledger.step_done(ledger_progress, 'bucket') and ledger_progress['member_bucket'].startswith(member_bucket_prefix)):
+            return None
+        ledger_bucket = ledger_progress['member_bucket']
+        s3_client = sh_clients.get_client('s3', results['member_session'])
+        if (member_account, ledger_bucket) not in _known_buckets and not bucket_exists(s3_client, ledger_bucket, member_account):
+            # deleted since it was recorded, the bucket and the template are set up again
+            print('Bucket: {} from ledger not found.'.format(ledger_bucket))
+            sh_ledger.reset_steps(member_account, 'bucket', 'template')
+            return None
+        _known_buckets.add((member_account, ledger_bucket))
+        print('Bucket: {} reused from ledger.'.format(ledger_bucket))
+        return ledger_bucket
+
+    def find_bucket(results):
+        if results['ledger_bucket']:
+            return results['ledger_bucket']
+        if reuse_bucket:
+            return get_indexed_bucket(results['member_session'], member_account, home_region, member_bucket_prefix)
+        return None
+
+    def create_bucket(results):
+        if results['found_bucket']:
+            if not results['ledger_bucket']:
+                print('Bucket: {} reused.'.format(results['found_bucket']))
+            return results['found_bucket']
+        timestamp = datetime.strftime(datetime.now(), '%Y%m%d%H%M%S')
+        member_bucket = '{}-{}'.format(member_bucket_prefix, timestamp)
+        for _ in range(bucket_name_attempts):
+            # the access block, the policy and the index are applied concurrently once the bucket exists
+            if create_bucket_if_not_exists(results['member_session'], member_bucket, block_public_access=False, member_account=member_account):
+                return member_bucket
+            member_bucket = '{}-{}-{}'.format(member_bucket_prefix, timestamp, uuid.uuid4().hex[:8])
+        raise RuntimeError('No free bucket name for prefix {} after {} attempts'.format(member_bucket_prefix, bucket_name_attempts))
+
+    # a reused bucket is already configured
+    def block_bucket(results):
+        if not results['found_bucket']:
+            put_public_access_block(results['member_session'], results['bucket'])
+
+    def grant_bucket(results):
+        if not results['found_bucket']:
+            create_cross_account_bucket_policy(results['member_session'], member_account, master_account, role_name, results['bucket'])
+
+    def publish_bucket(results):
+        if not results['found_bucket']:
+            index_bucket(results['member_session'], home_region, results['bucket'])
+
+    def record_bucket(results):
+        if not results['ledger_bucket']:
+            sh_ledger.record_step(member_account, 'bucket', member_bucket=results['bucket'])
+        return results['bucket']
+
+    def distribute(results):
+        ledger_progress = results['progress']
+        member_bucket = results['bucket_ready']
+        template_hash = results['template_hash']
+        if (sh_ledger.step_done(ledger_progress, 'template') and ledger_progress.get('template_hash') == template_hash
+                and ledger_progress.get('member_bucket') == member_bucket):
+            if template_exists(results['member_session'], member_bucket, ledger_progress['cfn_template_key']):
+                print('CFN Template: {} already distributed to Bucket: {}.'.format(ledger_progress['cfn_template_key'], member_bucket))
+                return ledger_progress['cfn_template_key'], template_hash
+            print('CFN Template: {} from ledger not found in Bucket: {}.'.format(ledger_progress['cfn_template_key'], member_bucket))
+            sh_ledger.reset_steps(member_account, 'template')
+        cfn_template_key, template_hash = distribute_template(
+            results['master_session'], results['member_session'], master_bucket, member_bucket, cfn_template_name, template_hash)
+        sh_ledger.record_step(member_account, 'template', cfn_template_key=cfn_template_key, template_hash=template_hash)
+        return cfn_template_key, template_hash
+
+    results, step_timings = sh_steps.run_steps({
+        'progress': sh_steps.step(lambda results: sh_ledger.get_progress(member_account) if progress is None else progress),
+        'member_regions': sh_steps.step(lambda results: get_member_regions(event)),
+        'master_session': sh_steps.step(lambda results: assume_role(org_id, master_account, role_name)),
+        'template_hash': sh_steps.step(
+            lambda results: get_template_hash(results['master_session'], master_bucket, cfn_template_name), 'master_session'),
+        'member_session': sh_steps.step(lambda results: assume_role(org_id, member_account, role_name)),
+        'ledger_bucket': sh_steps.step(get_ledger_bucket, 'progress', 'member_session'),
+        'found_bucket': sh_steps.step(find_bucket, 'ledger_bucket'),
+        'bucket': sh_steps.step(create_bucket, 'found_bucket'),
+        'public_access_block': sh_steps.step(block_bucket, 'bucket'),
+        'bucket_policy': sh_steps.step(grant_bucket, 'bucket'),
+        'bucket_index': sh_steps.step(publish_bucket, 'bucket'),
+        'bucket_ready': sh_steps.step(record_bucket, 'public_access_block', 'bucket_policy', 'bucket_index'),
+        'template': sh_steps.step(distribute, 'progress', 'template_hash', 'bucket_ready')
+    })
+    member_regions = results['member_regions']
+    member_bucket = results['bucket_ready']
+    cfn_template_key, template_hash = results['template']
+    for step_name, elapsed in step_timings.items():
+        sh_metrics.put_metric('StepTime', elapsed, 'Milliseconds', Step=step_name)
+    LOGGER.info(f"Credential cache: {sh_credentials.get_cache_stats()}")
     return {
         'org_id': org_id,
         'assume_role': role_name,
@@ -236,10 +529,19 @@ def lambda_handler(event, context):
         'master_bucket': master_bucket,
         'member_email': member_email,
         'member_region': home_region,
+        'member_regions': member_regions,
         'member_bucket': member_bucket,
-        'cfn_template_name': cfn_template_name
+        'cfn_template_name': cfn_template_name,
+        'cfn_template_key': cfn_template_key,
+        'template_hash': template_hash,
+        'step_timings_ms': step_timings
     }
-    #return sh_ops_regions
+
+@sh_metrics.instrumented('SHOpsBucketCopier')
+@sh_clients.surface_throttling
+def lambda_handler(event, context):
+    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    return prepare_member_bucket(event)
 
 
 #if __name__ == '__main__':
@@ -0,0 +1,39 @@
+import os
+import json
+import time
+import logging
+import sh_clients
+import sh_credentials
+import sh_ledger
+import sh_metrics
+import sh_ops_bucket
+import sh_remediator
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+def run_pipeline(event):
+    # bucket setup, template copy and stack launch in one process: one cold start,
+    # one ledger read, and the master and member sessions assumed once
+    started = time.perf_counter()
+    progress = sh_ledger.get_progress(event['member_account'])
+    copier_response = sh_ops_bucket.prepare_member_bucket(event, progress)
+    copied = time.perf_counter()
+    remediator_response = sh_remediator.launch_member_stacks(copier_response, progress)
+    launched = time.perf_counter()
+    sh_metrics.put_metric('CopyTime', (copied - started) * 1000, 'Milliseconds')
+    sh_metrics.put_metric('LaunchTime', (launched - copied) * 1000, 'Milliseconds')
+    print('Pipeline for Account {}: copy {:.0f} ms, launch {:.0f} ms'.format(
+        event['member_account'], (copied - started) * 1000, (launched - copied) * 1000))
+    LOGGER.info(f"Credential cache: {sh_credentials.get_cache_stats()}")
+    return remediator_response
+
+@sh_metrics.instrumented('SHRemediationPipeline')
+@sh_clients.surface_throttling
+def lambda_handler(event, context):
+    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    return run_pipeline(event)
@@ -1,11 +1,17 @@
-import email
 import os
-import sys
+import re
 import json
-import boto3
-import urllib3
+import time
+import threading
 import logging
-from datetime import date, datetime
+import sh_clients
+import sh_credentials
+import sh_ledger
+import sh_metrics
+import sh_ops_bucket
+from datetime import date, datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import ClientError
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -14,7 +20,30 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
-session = boto3.Session()
+complete_statuses = ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE')
+# a stack that never got created cannot be updated and has to be replaced
+replace_statuses = ('CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_FAILED')
+template_hash_tag = 'sh-remediation:template-hash'
+stack_set_admin_role = os.environ.get('stack_set_admin_role', 'service-role/AWSControlTowerStackSetRole')
+poll_wait_seconds = int(os.environ.get('stack_poll_wait', '15'))
+poll_max_wait_seconds = int(os.environ.get('stack_poll_max_wait', '300'))
+poll_limit = int(os.environ.get('stack_poll_limit', '60'))
+rollout_concurrency = int(os.environ.get('rollout_concurrency', '20'))
+# seconds a rollout wave keeps free for its last batch of change sets
+rollout_time_margin = int(os.environ.get('rollout_time_margin', '120'))
+failure_tolerance_percentage = int(os.environ.get('failure_tolerance_percentage', '10'))
+region_concurrency = int(os.environ.get('region_concurrency', '8'))
+stack_capabilities = ['CAPABILITY_NAMED_IAM']
+# capabilities the template may require, CAPABILITY_NAMED_IAM also grants CAPABILITY_IAM
+granted_capabilities = ('CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM')
+email_pattern = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+# template hash -> declared parameters and capabilities, shared by every account and region
+_template_summaries = {}
+_summary_locks = {}
+_lock = threading.Lock()
+
+class PreflightError(Exception):
+    pass
 
 def json_serial(obj):
     if isinstance(obj, (datetime, date)):
@@ -22,62 +51,628 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    role_arn = response['AssumedRoleUser']['Arn']
+    role_session = sh_credentials.get_role_session(org_id, aws_account_number, role_name)
     LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session, role_arn
+    return role_session['session'], role_session['role_arn']
+
+def get_stack_state(stack_status):
+    if stack_status.endswith('_IN_PROGRESS'):
+        return 'IN_PROGRESS'
+    if stack_status in complete_statuses:
+        return 'COMPLETE'
+    if stack_status == 'DELETE_COMPLETE':
+        return 'DELETED'
+    return 'FAILED'
+
+def get_cfn_client(member_session, member_region):
+    return sh_clients.get_client('cloudformation', member_session, member_region,
+        endpoint_url=f"https://cloudformation.{member_region}.amazonaws.com")
+
+def describe_stack(cfn_client, stack_name):
+    try:
+        response = cfn_client.describe_stacks(StackName=stack_name)
+        return response['Stacks'][0]
+    except ClientError as e:
+        if 'does not exist' in e.response['Error']['Message']:
+            return None
+        raise e
+
+def get_stack_params(event, role_arn):
+    cfn_params = []
+    admin_arn_param = {
+        'ParameterKey': 'AdministratorARN',
+        'ParameterValue': role_arn
+    }
+    email_param = {
+        'ParameterKey': 'AdminSNSNotificationEmailAddress',
+        'ParameterValue': event['member_email']
+    }
+    cfn_params.append(admin_arn_param)
+    cfn_params.append(email_param)
+    return cfn_params
+
+def get_stack_tags(event):
+    if not event.get('template_hash'):
+        return []
+    return [{
+        'Key': template_hash_tag,
+        'Value': event['template_hash']
+    }]
+
+def parse_template_summary(cfn_client, template_url):
+    try:
+        response = cfn_client.get_template_summary(TemplateURL=template_url)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ValidationError':
+            raise PreflightError('Template {} is invalid: {}'.format(template_url, e.response['Error']['Message'])) from e
+        raise e
+    return {
+        'parameters': {
+            parameter['ParameterKey']: parameter for parameter in response.get('Parameters', [])
+        },
+        'capabilities': response.get('Capabilities', [])
+    }
+
+def get_template_summary(cfn_client, template_url, template_hash=None):
+    # only content-addressed templates can be cached safely
+    if not template_hash:
+        return parse_template_summary(cfn_client, template_url)
+    if template_hash in _template_summaries:
+        return _template_summaries[template_hash]
+    with _lock:
+        summary_lock = _summary_locks.setdefault(template_hash, threading.Lock())
+    # regions launched in parallel wait for the first parse instead of repeating it
+    with summary_lock:
+        if template_hash not in _template_summaries:
+            _template_summaries[template_hash] = parse_template_summary(cfn_client, template_url)
+            LOGGER.info(f"Template summary cached for {template_hash}")
+    return _template_summaries[template_hash]
+
+def preflight_stack(cfn_client, template_url, cfn_params, template_hash=None):
+    summary = get_template_summary(cfn_client, template_url, template_hash)
+    declared = summary['parameters']
+    passed = {param['ParameterKey']: param['ParameterValue'] for param in cfn_params}
+    problems = []
+    for key in passed:
+        if key not in declared:
+            problems.append('Parameter {} is not declared by the template'.format(key))
+    for key, parameter in declared.items():
+        if key not in passed and 'DefaultValue' not in parameter:
+            problems.append('Parameter {} is required by the template'.format(key))
+        allowed_values = parameter.get('ParameterConstraints', {}).get('AllowedValues')
+        if key in passed and allowed_values and passed[key] not in allowed_values:
+            problems.append('Parameter {} must be one of {}'.format(key, ', '.join(allowed_values)))
+    for capability in summary['capabilities']:
+        if capability not in granted_capabilities:
+            problems.append('Capability {} is required by the template'.format(capability))
+    if not email_pattern.match(passed.get('AdminSNSNotificationEmailAddress', '')):
+        problems.append('AdminSNSNotificationEmailAddress {!r} is not an email address'.format(
+            passed.get('AdminSNSNotificationEmailAddress', '')))
+    if not passed.get('AdministratorARN', '').startswith('arn:'):
+        problems.append('AdministratorARN {!r} is not an ARN'.format(passed.get('AdministratorARN', '')))
+    if problems:
+        raise PreflightError('; '.join(problems))
 
 def launch_stack(member_session, event, role_arn):
     try:
         member_account = event['member_account']
-        member_email = event['member_email']
         member_region = event['member_region']
         cfn_template_bucket = event['member_bucket']
-        cfn_template_file = event['cfn_template_name']
+        # content-addressed key when SHOpsBucketCopier provides one
+        cfn_template_file = event.get('cfn_template_key', event['cfn_template_name'])
         stack_name = 'SHRemediator-{}'.format(member_account)
         template_url = 'https://{}.s3.amazonaws.com/{}'.format(cfn_template_bucket, cfn_template_file)
-        cfn_client = member_session.client('cloudformation',
-            endpoint_url=f"https://cloudformation.{member_region}.amazonaws.com", 
-            region_name=member_region)
-        cfn_params = []
-        admin_arn_param = {
-            'ParameterKey': 'AdministratorARN',
-            'ParameterValue': role_arn
-        }
-        email_param = {
-            'ParameterKey': 'AdminSNSNotificationEmailAddress',
-            'ParameterValue': member_email
-        }
-        cfn_params.append(admin_arn_param)
-        cfn_params.append(email_param)
-        response = cfn_client.create_stack(
+        cfn_client = get_cfn_client(member_session, member_region)
+        cfn_params = get_stack_params(event, role_arn)
+        # fail in milliseconds instead of after a rollback
+        preflight_stack(cfn_client, template_url, cfn_params, event.get('template_hash'))
+        stack = describe_stack(cfn_client, stack_name)
+        if stack is None:
+            response = cfn_client.create_stack(
+                StackName=stack_name,
+                TemplateURL=template_url,
+                Parameters=cfn_params,
+                Capabilities=stack_capabilities,
+                Tags=get_stack_tags(event),
+                OnFailure='DO_NOTHING'
+            )
+            print('SecurityHub Remediation Stack launched with Id: {}'.format(response['StackId']))
+            return response['StackId'], 'CREATE', None
+        stack_id = stack['StackId']
+        stack_state = get_stack_state(stack['StackStatus'])
+        if stack_state == 'IN_PROGRESS':
+            print('SecurityHub Remediation Stack: {} is {}. Tracking it.'.format(stack_id, stack['StackStatus']))
+            return stack_id, 'NONE', None
+        if stack['StackStatus'] in replace_statuses:
+            # a failed create cannot be updated, the stack is relaunched once deleted
+            cfn_client.delete_stack(StackName=stack_id)
+            print('SecurityHub Remediation Stack: {} is {}. Deleting it.'.format(stack_id, stack['StackStatus']))
+            return stack_id, 'DELETE', None
+        change_set_id = update_stack(cfn_client, stack_name, template_url, cfn_params, event)
+        return stack_id, 'CHANGE_SET', change_set_id
+    except Exception as e:
+        print(f'failed in create_stack(..): {e}')
+        print(str(e))
+        raise e
+
+def is_empty_change_set(change_set):
+    reason = change_set.get('StatusReason', '')
+    return change_set['Status'] == 'FAILED' and (
+        "didn't contain changes" in reason or 'No updates are to be performed' in reason)
+
+def update_stack(cfn_client, stack_name, template_url, cfn_params, event):
+    # a change set only touches the resources that differ, and tells when nothing does;
+    # it is executed by advance_change_set once CloudFormation has computed it
+    change_set_name = 'sh-remediation-{}-{}'.format(
+        (event.get('template_hash') or 'update')[:12], datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S'))
+    try:
+        response = cfn_client.create_change_set(
             StackName=stack_name,
+            ChangeSetName=change_set_name,
+            ChangeSetType='UPDATE',
             TemplateURL=template_url,
             Parameters=cfn_params,
-            Capabilities=[ 'CAPABILITY_NAMED_IAM' ],
-            OnFailure='DO_NOTHING'
+            Capabilities=stack_capabilities,
+            Tags=get_stack_tags(event)
         )
-        print('SecurityHub Remediation Stack launched with Id: {}'.format(response['StackId']))
-        return response['StackId']
     except Exception as e:
-        print(f'failed in create_stack(..): {e}')
+        print(f'failed in create_change_set(..): {e}')
         print(str(e))
+        raise e
+    print('SecurityHub Remediation Stack: {} change set {} created.'.format(stack_name, change_set_name))
+    return response['Id']
 
-def lambda_handler(event, context):
+def advance_change_set(cfn_client, change_set_id):
+    # returns (stack_operation, reason): PENDING while CloudFormation computes the change set,
+    # NONE when it held no changes, UPDATE once executed, FAILED when it could not be created
+    try:
+        change_set = cfn_client.describe_change_set(ChangeSetName=change_set_id)
+        if change_set['Status'] in ('CREATE_PENDING', 'CREATE_IN_PROGRESS'):
+            return 'PENDING', ''
+        if is_empty_change_set(change_set) or (change_set['Status'] == 'CREATE_COMPLETE' and not change_set.get('Changes')):
+            cfn_client.delete_change_set(ChangeSetName=change_set_id)
+            print('SecurityHub Remediation Stack: {} is up to date.'.format(change_set['StackName']))
+            return 'NONE', ''
+        if change_set['Status'] != 'CREATE_COMPLETE':
+            return 'FAILED', 'Change set {} is {}: {}'.format(
+                change_set['ChangeSetName'], change_set['Status'], change_set.get('StatusReason', ''))
+        # a run picked up from the ledger may find the change set already executed
+        if change_set['ExecutionStatus'] == 'AVAILABLE':
+            cfn_client.execute_change_set(ChangeSetName=change_set_id)
+            print('SecurityHub Remediation Stack: {} updated with {} changes.'.format(
+                change_set['StackName'], len(change_set.get('Changes', []))))
+    except cfn_client.exceptions.ChangeSetNotFoundException:
+        # deleted as empty by an earlier run, the stack status tells the rest
+        return 'NONE', ''
+    except Exception as e:
+        print(f'failed in execute_change_set(..): {e}')
+        print(str(e))
+        raise e
+    return 'UPDATE', ''
+
+def get_stack_failure_reason(cfn_client, stack_id):
+    try:
+        response = cfn_client.describe_stack_events(StackName=stack_id)
+        for stack_event in response['StackEvents']:
+            if stack_event['ResourceStatus'].endswith('_FAILED'):
+                return '{}: {}'.format(stack_event['LogicalResourceId'], stack_event.get('ResourceStatusReason', ''))
+    except Exception as e:
+        print(f'failed in describe_stack_events(..): {e}')
+        print(str(e))
+    return ''
+
+def next_poll(event, stack_state):
+    # exponential backoff between polls, capped, driven by the state machine Wait state
+    event['poll_count'] = event.get('poll_count', 0) + 1
+    event['wait_seconds'] = min(event.get('wait_seconds', poll_wait_seconds) * 2, poll_max_wait_seconds)
+    if stack_state == 'IN_PROGRESS' and event['poll_count'] >= poll_limit:
+        stack_state = 'TIMED_OUT'
+        event['stack_status_reason'] = 'Stack still in progress after {} polls'.format(event['poll_count'])
+    event['stack_state'] = stack_state
+    return event
+
+def describe_region_stack(member_session, region_stack):
+    cfn_client = get_cfn_client(member_session, region_stack['region'])
+    if region_stack.get('change_set_id'):
+        stack_operation, reason = advance_change_set(cfn_client, region_stack['change_set_id'])
+        if stack_operation in ('PENDING', 'FAILED'):
+            region_stack['stack_status'] = 'CHANGE_SET_{}'.format(stack_operation)
+            region_stack['stack_state'] = 'IN_PROGRESS' if stack_operation == 'PENDING' else 'FAILED'
+            region_stack['stack_status_reason'] = reason
+            return region_stack
+        del region_stack['change_set_id']
+        region_stack['stack_operation'] = stack_operation
+        if stack_operation == 'UPDATE':
+            # the stack may not report the update yet, the next poll does
+            region_stack['stack_status'] = 'CHANGE_SET_EXECUTED'
+            region_stack['stack_state'] = 'IN_PROGRESS'
+            region_stack['stack_status_reason'] = ''
+            return region_stack
+    try:
+        response = cfn_client.describe_stacks(StackName=region_stack['stack_id'])
+        stack = response['Stacks'][0]
+    except Exception as e:
+        print(f'failed in describe_stacks(..): {e}')
+        print(str(e))
+        raise e
+    stack_state = get_stack_state(stack['StackStatus'])
+    region_stack['stack_status'] = stack['StackStatus']
+    region_stack['stack_state'] = stack_state
+    region_stack['stack_status_reason'] = stack.get('StackStatusReason', '')
+    if stack_state == 'FAILED':
+        region_stack['stack_status_reason'] = get_stack_failure_reason(cfn_client, region_stack['stack_id']) or region_stack['stack_status_reason']
+    if stack_state in ('COMPLETE', 'FAILED') and 'completed_at' not in region_stack:
+        region_stack['completed_at'] = datetime.now(timezone.utc).isoformat()
+    print('SecurityHub Remediation Stack: {} is {}'.format(region_stack['stack_id'], stack['StackStatus']))
+    return region_stack
+
+def track_stack(event):
+    member_session, role_arn = assume_role(event['org_id'], event['member_account'], event['assume_role'])
+    stacks = event.get('stacks') or [{
+        'region': event['member_region'],
+        'stack_id': event['stack_id']
+    }]
+    with ThreadPoolExecutor(max_workers=min(len(stacks), region_concurrency)) as executor:
+        stacks = list(executor.map(lambda region_stack: describe_region_stack(member_session, region_stack), stacks))
+    states = [region_stack['stack_state'] for region_stack in stacks]
+    # wait for every region before reporting a failure, relaunch only when nothing failed
+    stack_state = 'COMPLETE'
+    for state in ('IN_PROGRESS', 'FAILED', 'DELETED'):
+        if state in states:
+            stack_state = state
+            break
+    event['stacks'] = stacks
+    event['stack_status'] = stacks[0]['stack_status']
+    event['stack_status_reason'] = '; '.join(
+        '{}: {}'.format(region_stack['region'], region_stack['stack_status_reason'])
+        for region_stack in stacks if region_stack['stack_state'] == 'FAILED')
+    event = next_poll(event, stack_state)
+    record_outcome(event['member_account'], event['stack_state'], event['stack_status_reason'], event.get('execution_name'))
+    return event
+
+def record_outcome(member_account, stack_state, reason, owner):
+    # a deleted stack is launched again by the same execution, which keeps its claim
+    if stack_state in ('IN_PROGRESS', 'DELETED'):
+        return
+    if stack_state == 'COMPLETE':
+        sh_ledger.record_step(member_account, 'stack', status='REMEDIATED')
+    else:
+        # the next run launches the stack again
+        sh_ledger.record_step(member_account, 'stack', 'FAILED', status='FAILED', stack_status_reason=reason or stack_state)
+    # the next event for this account may start a new execution
+    sh_ledger.release(member_account, owner)
+
+def get_stack_set_state(operation_status):
+    if operation_status in ('RUNNING', 'QUEUED', 'STOPPING'):
+        return 'IN_PROGRESS'
+    if operation_status == 'SUCCEEDED':
+        return 'COMPLETE'
+    return 'FAILED'
+
+def track_stack_set(event):
+    cfn_client = sh_clients.get_client('cloudformation')
+    states = []
+    failures = []
+    for operation in event['stack_set_operations']:
+        if operation.get('stack_state', 'IN_PROGRESS') == 'IN_PROGRESS':
+            try:
+                response = cfn_client.describe_stack_set_operation(
+                    StackSetName=event['stack_set_name'],
+                    OperationId=operation['operation_id'])
+            except Exception as e:
+                print(f'failed in describe_stack_set_operation(..): {e}')
+                print(str(e))
+                raise e
+            operation['status'] = response['StackSetOperation']['Status']
+            operation['stack_state'] = get_stack_set_state(operation['status'])
+            if operation['stack_state'] == 'FAILED':
+                operation['reason'] = response['StackSetOperation'].get('StatusReason', operation['status'])
+        states.append(operation['stack_state'])
+        if operation['stack_state'] == 'FAILED':
+            failures.append('{}: {}'.format(operation['member_account'], operation['reason']))
+    record_stack_set_outcomes(event)
+    if 'IN_PROGRESS' in states:
+        stack_state = 'IN_PROGRESS'
+    elif failures:
+        stack_state = 'FAILED'
+    else:
+        stack_state = 'COMPLETE'
+    event['stack_status_reason'] = '; '.join(failures)
+    print('StackSet: {} operations are {}'.format(event['stack_set_name'], stack_state))
+    return next_poll(event, stack_state)
+
+def record_stack_set_outcomes(event):
+    # an account settles with its own operation, or with the update of every existing instance;
+    # an account without either already runs the current template
+    operations = {operation['member_account']: operation for operation in event['stack_set_operations']}
+    for account in event['accounts']:
+        if account.get('stack_state', 'IN_PROGRESS') != 'IN_PROGRESS':
+            continue
+        operation = operations.get(account['member_account']) or operations.get('*')
+        account['stack_state'] = operation['stack_state'] if operation else 'COMPLETE'
+        reason = operation.get('reason', '') if operation else ''
+        record_outcome(account['member_account'], account['stack_state'], reason, event.get('execution_name'))
+
+def get_stack_set_params(event, account):
+    partition = sh_credentials.get_partition()
+    # each account administers its own resources through the StackSet execution role
+    role_arn = 'arn:{}:iam::{}:role/{}'.format(partition, account['member_account'], event['assume_role'])
+    return get_stack_params({'member_email': account['member_email']}, role_arn)
+
+def get_template_hash(bucket_name, cfn_template_name):
+    try:
+        s3_client = sh_clients.get_client('s3')
+        response = s3_client.head_object(Bucket=bucket_name, Key=cfn_template_name)
+        return response['ETag'].strip('"')
+    except Exception as e:
+        print(f'failed in head_object(..): {e}')
+        print(str(e))
+        raise e
+
+def deploy_stack_set(event):
+    stack_set_name = event.get('stack_set_name', os.environ.get('stack_set_name', 'SHRemediator'))
+    # bulk input carries no member_regions, the Control Tower regions apply to every account
+    regions = event.get('member_regions') or sh_ops_bucket.get_member_regions(event)
+    template_url = 'https://{}.s3.amazonaws.com/{}'.format(event['master_bucket'], event['cfn_template_name'])
+    event['template_hash'] = get_template_hash(event['master_bucket'], event['cfn_template_name'])
+    stack_set_args = {
+        'StackSetName': stack_set_name,
+        'TemplateURL': template_url,
+        'Parameters': get_stack_set_params(event, event['accounts'][0]),
+        'Capabilities': stack_capabilities,
+        'Tags': get_stack_tags(event),
+        'AdministrationRoleARN': 'arn:{}:iam::{}:role/{}'.format(
+            sh_credentials.get_partition(), event['master_account'], stack_set_admin_role),
+        'ExecutionRoleName': event['assume_role']
+    }
+    preferences = {
+        'RegionConcurrencyType': 'PARALLEL',
+        'MaxConcurrentPercentage': 100,
+        'FailureTolerancePercentage': 0
+    }
+    operations = []
+    cfn_client = sh_clients.get_client('cloudformation')
+    try:
+        try:
+            response = cfn_client.describe_stack_set(StackSetName=stack_set_name)
+            tags = {tag['Key']: tag['Value'] for tag in response['StackSet'].get('Tags', [])}
+            if tags.get(template_hash_tag) != event['template_hash']:
+                # one operation rolls the new template out to every existing instance
+                response = cfn_client.update_stack_set(OperationPreferences=preferences, **stack_set_args)
+                operations.append({'member_account': '*', 'operation_id': response['OperationId']})
+                print('StackSet: {} updated to template {}'.format(stack_set_name, event['template_hash']))
+        except cfn_client.exceptions.StackSetNotFoundException:
+            # let CloudFormation run non-conflicting operations concurrently
+            cfn_client.create_stack_set(
+                Description='SecurityHub CIS benchmark remediation',
+                ManagedExecution={'Active': True},
+                **stack_set_args)
+            print('StackSet: {} created'.format(stack_set_name))
+        existing = set()
+        paginator = cfn_client.get_paginator('list_stack_instances')
+        for page in paginator.paginate(StackSetName=stack_set_name):
+            for summary in page['Summaries']:
+                existing.add((summary['Account'], summary['Region']))
+        for account in event['accounts']:
+            member_account = account['member_account']
+            new_regions = [region for region in regions if (member_account, region) not in existing]
+            if not new_regions:
+                continue
+            # email and administrator differ per account, so each account is its own operation
+            response = cfn_client.create_stack_instances(
+                StackSetName=stack_set_name,
+                Accounts=[member_account],
+                Regions=new_regions,
+                ParameterOverrides=get_stack_set_params(event, account),
+                OperationPreferences=preferences)
+            operations.append({'member_account': member_account, 'operation_id': response['OperationId']})
+        print('StackSet: {} deploying to {} Accounts in {} Regions'.format(stack_set_name, len(event['accounts']), len(regions)))
+    except Exception as e:
+        print(f'failed in create_stack_instances(..): {e}')
+        print(str(e))
+        raise e
+    event['stack_set_name'] = stack_set_name
+    event['stack_set_operations'] = operations
+    event['poll_count'] = 0
+    event['wait_seconds'] = poll_wait_seconds
+    return event
+
+@sh_metrics.instrumented('SHRemediatorStackSetDeployer')
+@sh_clients.surface_throttling
+def stack_set_handler(event, context):
+    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    return deploy_stack_set(event)
+
+@sh_metrics.instrumented('SHRemediatorStackTracker')
+@sh_clients.surface_throttling
+def stack_status_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    if 'stack_set_operations' in event:
+        return track_stack_set(event)
+    return track_stack(event)
+
+def plan_account_rollout(event, account, master_session):
+    member_account = account['member_account']
+    member_session, role_arn = assume_role(event['org_id'], member_account, event['assume_role'])
+    cfn_client = get_cfn_client(member_session, event['home_region'])
+    stack = describe_stack(cfn_client, 'SHRemediator-{}'.format(member_account))
+    # a rollout only updates healthy stacks, missing or failed ones are left to the drift scanner
+    if stack is None or get_stack_state(stack['StackStatus']) != 'COMPLETE':
+        return dict(account, rollout_state='SKIPPED', reason='stack is {}'.format(stack['StackStatus'] if stack else 'missing'))
+    member_bucket = sh_ops_bucket.get_indexed_bucket(member_session, member_account, event['home_region'],
+        sh_ops_bucket.get_bucket_prefix(event['member_bucket'], member_account))
+    if member_bucket is None:
+        return dict(account, rollout_state='SKIPPED', reason='no ops bucket indexed')
+    # every account of the wave reuses the template staged by the first one
+    cfn_template_key, template_hash = sh_ops_bucket.distribute_template(
+        master_session, member_session, event['master_bucket'], member_bucket, event['cfn_template_name'], event['template_hash'],
+        staged=True)
+    stack_event = {
+        'member_account': member_account,
+        'member_email': account['member_email'],
+        'member_region': event['home_region'],
+        'member_bucket': member_bucket,
+        'cfn_template_name': event['cfn_template_name'],
+        'cfn_template_key': cfn_template_key,
+        'template_hash': template_hash
+    }
+    stack_id, stack_operation, change_set_id = launch_stack(member_session, stack_event, role_arn)
+    if stack_operation == 'NONE':
+        return dict(account, rollout_state='UNCHANGED', stack_id=stack_id)
+    return dict(account, rollout_state='IN_PROGRESS', stack_id=stack_id, change_set_id=change_set_id)
+
+def poll_account_rollout(event, account):
+    member_session, role_arn = assume_role(event['org_id'], account['member_account'], event['assume_role'])
+    cfn_client = get_cfn_client(member_session, event['home_region'])
+    if account.get('change_set_id'):
+        stack_operation, reason = advance_change_set(cfn_client, account['change_set_id'])
+        if stack_operation == 'PENDING':
+            return dict(account, rollout_state='IN_PROGRESS')
+        account = dict(account, change_set_id=None)
+        if stack_operation == 'NONE':
+            return dict(account, rollout_state='UNCHANGED')
+        if stack_operation == 'FAILED':
+            return dict(account, rollout_state='FAILED', reason=reason)
+        # executed just now, the stack reports the update from the next wave on
+        return dict(account, rollout_state='IN_PROGRESS')
+    stack = describe_stack(cfn_client, account['stack_id'])
+    stack_state = get_stack_state(stack['StackStatus']) if stack else 'DELETED'
+    if stack_state == 'IN_PROGRESS':
+        return dict(account, rollout_state='IN_PROGRESS')
+    if stack_state == 'COMPLETE':
+        return dict(account, rollout_state='SUCCEEDED')
+    reason = get_stack_failure_reason(cfn_client, account['stack_id']) if stack else ''
+    return dict(account, rollout_state='FAILED', reason=reason or stack_state)
+
+def run_accounts(function, accounts):
+    results = []
+    if not accounts:
+        return results
+    with ThreadPoolExecutor(max_workers=len(accounts)) as executor:
+        futures = {executor.submit(function, account): account for account in accounts}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f'failed in rollout(..) for Account {futures[future]["member_account"]}: {e}')
+                results.append(dict(futures[future], rollout_state='FAILED', reason=str(e)))
+    return results
+
+def record_rollout(event, status, results):
+    for account in results:
+        member_account = account['member_account']
+        if account['rollout_state'] == 'IN_PROGRESS':
+            status['in_flight'].append(account)
+        elif account['rollout_state'] in ('SUCCEEDED', 'UNCHANGED'):
+            status[account['rollout_state'].lower()].append(member_account)
+            sh_ledger.record_step(member_account, 'stack', status='REMEDIATED', stack_template_hash=event['template_hash'])
+        else:
+            status[account['rollout_state'].lower()].append({
+                'member_account': member_account,
+                'reason': account.get('reason', '')
+            })
+
+def has_rollout_time(context):
+    if context is None:
+        return True
+    return context.get_remaining_time_in_millis() > rollout_time_margin * 1000
+
+def rollout_wave(event, context=None):
+    if 'rollout_status' not in event:
+        event['template_hash'] = get_template_hash(event['master_bucket'], event['cfn_template_name'])
+        # accounts move from pending to in_flight to a final list, the input list is not kept
+        event['rollout_total'] = len(event['accounts'])
+        event['rollout_status'] = {
+            'pending': event.pop('accounts'),
+            'in_flight': [],
+            'succeeded': [],
+            'unchanged': [],
+            'skipped': [],
+            'failed': []
+        }
+    status = event['rollout_status']
+    concurrency = int(event.get('rollout_concurrency', rollout_concurrency))
+    tolerance = int(event.get('failure_tolerance_percentage', failure_tolerance_percentage))
+    allowed_failures = event['rollout_total'] * tolerance // 100
+    in_flight, status['in_flight'] = status['in_flight'], []
+    record_rollout(event, status, run_accounts(lambda account: poll_account_rollout(event, account), in_flight))
+    master_session = None
+    # keep up to concurrency stacks updating; unchanged and skipped accounts free their slot at once
+    while (status['pending'] and len(status['failed']) <= allowed_failures and len(status['in_flight']) < concurrency
+            and has_rollout_time(context)):
+        master_session = master_session or assume_role(event['org_id'], event['master_account'], event['assume_role'])[0]
+        slots = concurrency - len(status['in_flight'])
+        batch, status['pending'] = status['pending'][:slots], status['pending'][slots:]
+        record_rollout(event, status, run_accounts(lambda account: plan_account_rollout(event, account, master_session), batch))
+    if status['in_flight']:
+        event['rollout_state'] = 'IN_PROGRESS'
+    elif len(status['failed']) > allowed_failures:
+        event['rollout_state'] = 'FAILED'
+        event['rollout_reason'] = '{} of {} Accounts failed, {}% tolerated; {} Accounts not updated: {}'.format(
+            len(status['failed']), event['rollout_total'], tolerance, len(status['pending']),
+            '; '.join('{}: {}'.format(account['member_account'], account['reason']) for account in status['failed']))[:32000]
+    elif status['pending']:
+        # out of time for this wave, the next one continues with the pending accounts
+        event['rollout_state'] = 'IN_PROGRESS'
+    else:
+        event['rollout_state'] = 'COMPLETE'
+    event['wait_seconds'] = poll_wait_seconds * 2
+    print('Rollout of template {}: {} updating, {} updated, {} unchanged, {} skipped, {} failed, {} pending'.format(
+        event['template_hash'], len(status['in_flight']), len(status['succeeded']), len(status['unchanged']),
+        len(status['skipped']), len(status['failed']), len(status['pending'])))
+    return event
+
+@sh_metrics.instrumented('SHRemediatorRollout')
+@sh_clients.surface_throttling
+def rollout_handler(event, context):
+    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    return rollout_wave(event, context)
+
+def launch_region_stack(member_session, event, role_arn, region):
+    started = time.perf_counter()
+    stack_id, stack_operation, change_set_id = launch_stack(member_session, dict(event, member_region=region), role_arn)
+    return {
+        'region': region,
+        'stack_id': stack_id,
+        'stack_operation': stack_operation,
+        'change_set_id': change_set_id,
+        'launched_at': datetime.now(timezone.utc).isoformat(),
+        'launch_ms': round((time.perf_counter() - started) * 1000)
+    }
+
+def launch_stacks(member_session, event, role_arn, regions):
+    stacks = []
+    failures = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=min(len(regions), region_concurrency)) as executor:
+        futures = {
+            executor.submit(launch_region_stack, member_session, event, role_arn, region): region
+            for region in regions
+        }
+        for future in as_completed(futures):
+            try:
+                stacks.append(future.result())
+            except Exception as e:
+                failures.append('{}: {}'.format(futures[future], e))
+                errors.append(e)
+    for region_stack in stacks:
+        LOGGER.info('Region: {} stack {} in {} ms'.format(
+            region_stack['region'], region_stack['stack_operation'], region_stack['launch_ms']))
+    for error in errors:
+        # keep throttling visible to the state machine retry policy, and pre-flight failures by name
+        if isinstance(error, ClientError) and error.response['Error']['Code'] in sh_clients.throttle_codes:
+            raise error
+        if isinstance(error, PreflightError):
+            raise error
+    if failures:
+        # stacks already launched are picked up again as updates when the step is retried
+        raise RuntimeError('Stack launch failed in {} of {} Regions: {}'.format(
+            len(failures), len(regions), '; '.join(failures)))
+    # home region first
+    stacks.sort(key=lambda region_stack: regions.index(region_stack['region']))
+    return stacks
+
+def launch_member_stacks(event, progress=None):
     org_id = event['org_id']
     assume_role_name = event['assume_role']
     member_account = event['member_account']
@@ -85,8 +680,21 @@ def lambda_handler(event, context):
     member_region = event['member_region']
     cfn_template_bucket = event['member_bucket']
     cfn_template_name = event['cfn_template_name']
-    member_session, role_arn = assume_role(org_id, member_account, assume_role_name)
-    stack_id = launch_stack(member_session, event, role_arn)
+    regions = event.get('member_regions') or [member_region]
+    if progress is None:
+        progress = sh_ledger.get_progress(member_account)
+    if (sh_ledger.step_done(progress, 'stack') and event.get('template_hash')
+            and progress.get('stack_template_hash') == event['template_hash']
+            and progress.get('member_regions') == regions):
+        # launched by an earlier run of this template, only its status is tracked again
+        stacks = [dict(region_stack, stack_operation='NONE') for region_stack in progress['stacks']]
+        print('SecurityHub Remediation Stack: {} already launched. Launch skipped.'.format(stacks[0]['stack_id']))
+    else:
+        member_session, role_arn = assume_role(org_id, member_account, assume_role_name)
+        stacks = launch_stacks(member_session, event, role_arn, regions)
+        sh_ledger.record_step(member_account, 'stack', stack_id=stacks[0]['stack_id'], stacks=stacks,
+            member_regions=regions, stack_template_hash=event.get('template_hash'))
+    LOGGER.info(f"Credential cache: {sh_credentials.get_cache_stats()}")
     remediator_response = {
         'org_id': org_id,
         'assume_role': assume_role_name,
@@ -95,7 +703,19 @@ def lambda_handler(event, context):
         'member_region': member_region,
         'member_bucket': cfn_template_bucket,
         'cfn_template_name': cfn_template_name,
-        'stack_id': stack_id
+        'cfn_template_key': event.get('cfn_template_key', cfn_template_name),
+        'template_hash': event.get('template_hash'),
+        'member_regions': regions,
+        'stack_id': stacks[0]['stack_id'],
+        'stack_operation': stacks[0]['stack_operation'],
+        'stacks': stacks,
+        'poll_count': 0,
+        'wait_seconds': poll_wait_seconds
     }
     return remediator_response
 
+@sh_metrics.instrumented('SHRemediator')
+@sh_clients.surface_throttling
+def lambda_handler(event, context):
+    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    return launch_member_stacks(event)
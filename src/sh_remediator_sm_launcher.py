@@ -1,9 +1,13 @@
 import os
-import sys
+import re
 import json
-import boto3
-import urllib3
+import time
+import hashlib
 import logging
+import sh_clients
+import sh_credentials
+import sh_ledger
+import sh_metrics
 from datetime import date, datetime
 
 LOGGER = logging.getLogger()
@@ -13,7 +17,22 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
-session = boto3.Session()
+# resolved once per container, see get_state_machine_arn
+_sm_arn = None
+_sm_arn_source = None
+# environment read once per container, see get_config
+_config = None
+config_keys = (
+    'org_id', 'assume_role', 'master_account', 'home_region', 'master_bucket',
+    'sh_admin_account', 'member_bucket', 'cfn_template_name', 'sm_name'
+)
+account_pattern = re.compile(r'^[0-9]{12}$')
+email_pattern = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+# where the member data sits in the detail of a SecurityHubEnabled event
+member_data_path = ('serviceEventDetails', 'securityHubEnabledAccount')
+# accounts per bulk execution, keeps the Map output under the 256 KB payload limit
+# and the execution history under 25,000 events
+bulk_chunk_size = int(os.environ.get('bulk_chunk_size', '100'))
 
 def json_serial(obj):
     if isinstance(obj, (datetime, date)):
@@ -21,96 +40,402 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
+    role_session = sh_credentials.get_role_session(org_id, aws_account_number, role_name)
     LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+    return role_session['session']
 
-def start_workflow(input):
-    sm_name = os.environ['sm_name']
+def get_config():
+    global _config
+    if _config is None:
+        missing = [key for key in config_keys if not os.environ.get(key)]
+        if missing:
+            raise ValueError('Environment variables not set: {}'.format(', '.join(missing)))
+        _config = {key: os.environ[key] for key in config_keys}
+        _config['max_concurrency'] = int(os.environ.get('max_concurrency', '10'))
+        _config['deployment_mode'] = os.environ.get('deployment_mode', 'stacks')
+        # 'fused' runs bucket setup, template copy and stack launch in one Lambda invocation
+        _config['pipeline_mode'] = os.environ.get('pipeline_mode', 'standard')
+        # defaults of the copier, carried in the input so the Map can forward them to every account
+        _config['multi_region'] = os.environ.get('multi_region', 'false')
+        _config['reuse_bucket'] = os.environ.get('reuse_bucket', 'true')
+    return _config
+
+def lookup_state_machine_arn(sfn_client, sm_name):
+    paginator = sfn_client.get_paginator('list_state_machines')
+    iterator = paginator.paginate()
+    for page in iterator:
+        for sm in page['stateMachines']:
+            if sm['name'] == sm_name:
+                return sm['stateMachineArn']
+    raise ValueError('StateMachine: {} not found'.format(sm_name))
+
+def get_state_machine_arn(sfn_client, sm_name, refresh=False):
+    global _sm_arn, _sm_arn_source
+    started = time.perf_counter()
+    source = 'cache'
+    if refresh or _sm_arn is None:
+        if not refresh and os.environ.get('sm_arn'):
+            _sm_arn = os.environ['sm_arn']
+            source = 'env'
+        else:
+            _sm_arn = lookup_state_machine_arn(sfn_client, sm_name)
+            source = 'lookup'
+        _sm_arn_source = source
+    elapsed = (time.perf_counter() - started) * 1000
+    sh_metrics.put_metric('StateMachineArnResolveTime', elapsed, 'Milliseconds', Source=source)
+    LOGGER.info('StateMachine ARN resolved from {} in {:.1f} ms'.format(source, elapsed))
+    return _sm_arn
+
+def invalidate_state_machine_arn():
+    global _sm_arn, _sm_arn_source
+    _sm_arn = None
+    _sm_arn_source = None
+
+def execution_name(*parts):
+    # Step Functions allows up to 80 characters of [0-9A-Za-z_-]
+    name = '-'.join(str(part) for part in parts)
+    return re.sub(r'[^0-9A-Za-z_-]', '-', name)[:80]
+
+def get_event_id(event):
+    if 'id' in event:
+        return event['id']
+    return hashlib.sha256(json.dumps(event, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+def bulk_execution_name(accounts, event_id, prefix='bulk'):
+    member_accounts = ','.join(sorted(account['member_account'] for account in accounts))
+    digest = hashlib.sha256('{}:{}'.format(member_accounts, event_id).encode()).hexdigest()[:32]
+    return execution_name(prefix, digest)
+
+def chunk_accounts(accounts, size=None):
+    size = size or bulk_chunk_size
+    # sorted, so a retried invocation splits the same accounts into the same chunks
+    accounts = sorted(accounts, key=lambda account: account['member_account'])
+    return [accounts[index:index + size] for index in range(0, len(accounts), size)]
+
+def get_execution_status(sfn_client, sm_arn, exec_name):
+    exec_arn = '{}:{}'.format(sm_arn.replace(':stateMachine:', ':execution:', 1), exec_name)
+    try:
+        response = sfn_client.describe_execution(executionArn=exec_arn)
+        return exec_arn, response['status']
+    except sfn_client.exceptions.ExecutionDoesNotExist:
+        return exec_arn, None
+
+def claim_account(sfn_client, sm_arn, member_account, exec_name, holders):
+    # one conditional write in the ledger instead of listing every running execution
+    holder = sh_ledger.claim(member_account, exec_name)
+    if holder is None:
+        return True
+    if holder not in holders:
+        holders[holder] = get_execution_status(sfn_client, sm_arn, holder)[1]
+    if holders[holder] == 'RUNNING':
+        LOGGER.info('Account: {} is already being remediated by {}. Skipped.'.format(member_account, holder))
+        return False
+    # the execution holding the account ended without releasing it
+    return sh_ledger.claim(member_account, exec_name, holder) is None
+
+def launch_execution(sfn_client, sm_arn, input, exec_name):
+    exec_arn, status = get_execution_status(sfn_client, sm_arn, exec_name)
+    if status in ('RUNNING', 'SUCCEEDED'):
+        LOGGER.info('Execution: {} is already {}. Skipped.'.format(exec_name, status))
+        return exec_arn
+    if status is not None:
+        # names of Standard executions cannot be reused, so retry under a new one
+        exec_name = execution_name(exec_name[:60], 'retry', datetime.strftime(datetime.now(), '%Y%m%d%H%M%S'))
+    # a rollout only updates stacks that exist, it does not hold accounts
+    if not input.get('rollout'):
+        holders = {}
+        if 'accounts' in input:
+            accounts = [account for account in input['accounts']
+                if claim_account(sfn_client, sm_arn, account['member_account'], exec_name, holders)]
+            if not accounts:
+                return None
+            input = dict(input, accounts=accounts)
+        elif not claim_account(sfn_client, sm_arn, input['member_account'], exec_name, holders):
+            return None
     try:
-        sfn_client = session.client('stepfunctions')
-        paginator = sfn_client.get_paginator('list_state_machines')
-        iterator = paginator.paginate()
-        sm_arn = ''
-        exec_id = date.strftime(datetime.now(), '%Y%m%d%I%M%S')
-        for page in iterator:
-            for sm in page['stateMachines']:
-                if sm['name'] == sm_name:
-                    sm_arn = sm['stateMachineArn']
-                    break
-        LOGGER.info("Invoking StateMachine {} ..".format(sm_name))
         response = sfn_client.start_execution(
             stateMachineArn=sm_arn,
-            name=exec_id,
+            name=exec_name,
             input=json.dumps(input)
         )
-        execArn = response['executionArn']
-        LOGGER.info('StateMachine: {} started with Execution ARN: {}'.format(sm_name, execArn))
+    except sfn_client.exceptions.ExecutionAlreadyExists:
+        # the same event was delivered twice
+        LOGGER.info('Execution: {} already exists. Skipped.'.format(exec_name))
+        return get_execution_status(sfn_client, sm_arn, exec_name)[0]
+    return response['executionArn']
+
+def start_workflow(input, exec_name):
+    sm_name = get_config()['sm_name']
+    try:
+        sfn_client = sh_clients.get_client('stepfunctions')
+        sm_arn = get_state_machine_arn(sfn_client, sm_name)
+        LOGGER.info("Invoking StateMachine {} ..".format(sm_name))
+        try:
+            execArn = launch_execution(sfn_client, sm_arn, input, exec_name)
+        except sfn_client.exceptions.StateMachineDoesNotExist:
+            # StateMachine was replaced since the ARN was resolved
+            if _sm_arn_source == 'lookup':
+                raise
+            invalidate_state_machine_arn()
+            sm_arn = get_state_machine_arn(sfn_client, sm_name, refresh=True)
+            execArn = launch_execution(sfn_client, sm_arn, input, exec_name)
+        LOGGER.info('StateMachine: {} running with Execution ARN: {}'.format(sm_name, execArn))
+        return execArn
     except Exception as e:
+        invalidate_state_machine_arn()
         print(f'failed in start_execution(..): {e}')
         print(str(e))
-    
+        raise e
+
+def parse_sh_enabler_event(event):
+    # returns (member_data, None) or (None, reason); accepts the EventBridge 'detail'
+    # as well as the PutEvents 'Detail' shape, as a JSON string or an object
+    if not isinstance(event, dict):
+        return None, 'event is not an object'
+    detail = event.get('detail', event.get('Detail'))
+    if detail is None:
+        return None, 'event has no detail'
+    if isinstance(detail, str):
+        try:
+            detail = json.loads(detail)
+        except ValueError:
+            return None, 'detail is not valid JSON'
+    if not isinstance(detail, dict):
+        return None, 'detail is not an object'
+    member_data = detail
+    if 'EventName' in detail:
+        if detail['EventName'] != 'SecurityHubEnabled':
+            return None, 'EventName {} is not SecurityHubEnabled'.format(detail['EventName'])
+        for key in member_data_path:
+            member_data = member_data.get(key) if isinstance(member_data, dict) else None
+        if not isinstance(member_data, dict):
+            return None, 'detail has no {}'.format('.'.join(member_data_path))
+    member_account = str(member_data.get('member_account', ''))
+    member_email = member_data.get('member_email', '')
+    if not account_pattern.match(member_account):
+        return None, 'member_account {!r} is not a 12 digit account id'.format(member_account)
+    if not isinstance(member_email, str) or not email_pattern.match(member_email):
+        return None, 'member_email {!r} is not an email address'.format(member_email)
+    return {
+        'member_account': member_account,
+        'member_email': member_email
+    }, None
+
 def get_sh_enabler_event(event):
-    if 'detail' in event:
-        if 'EventName' in event['detail']:
-            if event['detail']['EventName'] == 'SecurityHubEnabled':
-                service_detail = event['detail']['serviceEventDetails']
-                member_data = service_detail['securityHubEnabledAccount']
-                member_account = member_data['member_account']
-                member_email = member_data['member_email']
-                print('Member Account: %s, Member Email: %s' % (member_account, member_email))
-                return  {
-                    'member_account': member_account,
-                    'member_email': member_email
-                }
-            else:
-                print('Event: \'SecurityHubEnabled\' NOT FOUND')
+    member_data, reason = parse_sh_enabler_event(event)
+    if member_data is None:
+        print('Event rejected: {}'.format(reason))
+        return None
+    print('Member Account: %s, Member Email: %s' % (member_data['member_account'], member_data['member_email']))
+    return member_data
+
+def reject_event(event, reason):
+    rejection = {
+        'rejected': True,
+        'reason': reason,
+        'event_id': get_event_id(event) if isinstance(event, dict) else None
+    }
+    print(json.dumps(rejection))
+    sh_metrics.put_metric('RejectedEvents', 1)
+    return rejection
 
 def prepare_input(event, member_data):
-    org_id = os.environ['org_id']
-    assume_role_name = os.environ['assume_role']
-    master_account = os.environ['master_account']
-    home_region = os.environ['home_region']
-    master_bucket = os.environ['master_bucket']
-    # get member data from event
-    member_account = member_data['member_account']
-    member_email = member_data['member_email']
-    sh_admin_account = os.environ['sh_admin_account']
-    member_bucket = os.environ['member_bucket']
-    cfn_template_name = os.environ['cfn_template_name']
+    config = get_config()
     return {
-        'org_id': org_id,
-        'assume_role': assume_role_name,
-        'master_account': master_account,
-        'home_region': home_region,
-        'master_bucket': master_bucket,
-        'member_account': member_account,
-        'member_email': member_email,
-        'sh_admin_account': sh_admin_account,
-        'member_bucket': member_bucket,
-        'cfn_template_name': cfn_template_name
+        'org_id': config['org_id'],
+        'assume_role': config['assume_role'],
+        'master_account': config['master_account'],
+        'home_region': config['home_region'],
+        'master_bucket': config['master_bucket'],
+        'member_account': member_data['member_account'],
+        'member_email': member_data['member_email'],
+        'sh_admin_account': config['sh_admin_account'],
+        'member_bucket': config['member_bucket'],
+        'cfn_template_name': config['cfn_template_name'],
+        'pipeline_mode': event.get('pipeline_mode', config['pipeline_mode']),
+        'multi_region': str(event.get('multi_region', config['multi_region'])).lower(),
+        'reuse_bucket': str(event.get('reuse_bucket', config['reuse_bucket'])).lower()
     }
 
+def list_accounts(ou_id):
+    accounts = []
+    try:
+        org_client = sh_clients.get_client('organizations')
+        paginator = org_client.get_paginator('list_accounts_for_parent')
+        iterator = paginator.paginate(ParentId=ou_id)
+        for page in iterator:
+            for account in page['Accounts']:
+                if account['Status'] == 'ACTIVE':
+                    accounts.append({
+                        'member_account': account['Id'],
+                        'member_email': account['Email']
+                    })
+    except Exception as e:
+        print(f'failed in list_accounts_for_parent(..): {e}')
+        print(str(e))
+        raise e
+    LOGGER.info(f"OU: {ou_id} expanded to {len(accounts)} Accounts")
+    return accounts
+
+def list_org_accounts(excluded=()):
+    accounts = []
+    try:
+        org_client = sh_clients.get_client('organizations')
+        paginator = org_client.get_paginator('list_accounts')
+        for page in paginator.paginate():
+            for account in page['Accounts']:
+                if account['Status'] == 'ACTIVE' and account['Id'] not in excluded:
+                    accounts.append({
+                        'member_account': account['Id'],
+                        'member_email': account['Email']
+                    })
+    except Exception as e:
+        print(f'failed in list_accounts(..): {e}')
+        print(str(e))
+        raise e
+    LOGGER.info(f"Organization has {len(accounts)} Member Accounts")
+    return accounts
+
+def describe_member(member_account):
+    try:
+        org_client = sh_clients.get_client('organizations')
+        response = org_client.describe_account(AccountId=member_account)
+        return {
+            'member_account': member_account,
+            'member_email': response['Account']['Email']
+        }
+    except Exception as e:
+        print(f'failed in describe_account(..): {e}')
+        print(str(e))
+        raise e
+
+def get_bulk_accounts(event):
+    accounts = []
+    if 'ou_id' in event:
+        accounts.extend(list_accounts(event['ou_id']))
+    for account in event.get('accounts', []):
+        # accept bare account ids as well as member_account/member_email pairs
+        if isinstance(account, str):
+            account = describe_member(account)
+        accounts.append({
+            'member_account': account['member_account'],
+            'member_email': account['member_email']
+        })
+    # the same account may be listed directly and through its OU
+    unique_accounts = {}
+    for account in accounts:
+        unique_accounts.setdefault(account['member_account'], account)
+    return list(unique_accounts.values())
+
+def prepare_bulk_input(event, accounts):
+    bulk_input = prepare_input(event, {
+        'member_account': '',
+        'member_email': ''
+    })
+    del bulk_input['member_account']
+    del bulk_input['member_email']
+    bulk_input['accounts'] = accounts
+    bulk_input['max_concurrency'] = int(event.get('max_concurrency', get_config()['max_concurrency']))
+    # 'stackset' deploys through one CloudFormation StackSet instead of per-account stacks
+    bulk_input['deployment_mode'] = event.get('deployment_mode', get_config()['deployment_mode'])
+    return bulk_input
+
+def start_bulk_workflows(event, accounts, event_id):
+    # one execution per chunk of accounts, each named after its own accounts
+    exec_arns = []
+    for chunk in chunk_accounts(accounts):
+        exec_arns.append(start_workflow(prepare_bulk_input(event, chunk), bulk_execution_name(chunk, event_id)))
+    return exec_arns
+
+def prepare_rollout_input(event, accounts):
+    rollout_input = prepare_bulk_input(event, accounts)
+    rollout_input['rollout'] = True
+    # the rollout Lambda falls back to its own defaults
+    for key in ('rollout_concurrency', 'failure_tolerance_percentage'):
+        if key in event:
+            rollout_input[key] = int(event[key])
+    return rollout_input
+
+def process_sqs_batch(event):
+    # member_account -> member data and every message that carried it
+    members = {}
+    batch_item_failures = []
+    for record in event['Records']:
+        message_id = record['messageId']
+        try:
+            sh_event = json.loads(record['body'])
+        except ValueError:
+            sh_event = None
+        member_data, reason = parse_sh_enabler_event(sh_event)
+        if member_data is None:
+            # retrying a malformed event cannot succeed, so it is dropped instead of sent to the DLQ
+            reject_event(sh_event, 'Message {}: {}'.format(message_id, reason))
+            continue
+        member = members.setdefault(member_data['member_account'], {
+            'member_data': member_data,
+            'event_ids': [],
+            'message_ids': []
+        })
+        member['event_ids'].append(get_event_id(sh_event))
+        member['message_ids'].append(message_id)
+    LOGGER.info(f"Batch of {len(event['Records'])} Messages coalesced to {len(members)} Accounts")
+    launches = []
+    if len(members) == 1:
+        member = list(members.values())[0]
+        input = prepare_input(event, member['member_data'])
+        exec_name = execution_name(member['member_data']['member_account'], member['event_ids'][0])
+        launches.append((input, exec_name, [member]))
+    elif members:
+        for accounts in chunk_accounts([member['member_data'] for member in members.values()]):
+            chunk = [members[account['member_account']] for account in accounts]
+            event_ids = sorted(member['event_ids'][0] for member in chunk)
+            launches.append((prepare_bulk_input(event, accounts), bulk_execution_name(accounts, ','.join(event_ids)), chunk))
+    for input, exec_name, chunk in launches:
+        try:
+            start_workflow(input, exec_name)
+        except Exception:
+            # only the messages of the chunk that failed to start go back to the queue
+            for member in chunk:
+                for message_id in member['message_ids']:
+                    batch_item_failures.append({'itemIdentifier': message_id})
+    return {
+        'batchItemFailures': batch_item_failures
+    }
+
+@sh_metrics.instrumented('SHRemediatorSMLauncher')
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    # buffered mode: batch of SecurityHubEnabled events from SHEnablerEventQueue
+    if 'Records' in event:
+        return process_sqs_batch(event)
+    # rollout mode: update existing stacks to the current template through change sets
+    if event.get('rollout'):
+        if 'accounts' in event or 'ou_id' in event:
+            accounts = get_bulk_accounts(event)
+        else:
+            accounts = list_org_accounts({get_config()['master_account']})
+        if not accounts:
+            print('No Accounts to roll out to')
+            return
+        # one execution per chunk keeps the rollout status within the state payload limit
+        for chunk in chunk_accounts(accounts):
+            start_workflow(prepare_rollout_input(event, chunk), bulk_execution_name(chunk, context.aws_request_id, 'rollout'))
+        return
+    # bulk mode: list of accounts and/or an OU id to expand
+    if 'accounts' in event or 'ou_id' in event:
+        accounts = get_bulk_accounts(event)
+        if not accounts:
+            print('No Accounts to remediate')
+            return
+        # retried invocations keep their request id
+        start_bulk_workflows(event, accounts, context.aws_request_id)
+        return
     # get member data from event
     # member_account
     # member_email
-    member_data = get_sh_enabler_event(event)
+    member_data, reason = parse_sh_enabler_event(event)
+    if member_data is None:
+        return reject_event(event, reason)
+    sh_metrics.set_dimension('MemberAccount', member_data['member_account'])
     input = prepare_input(event, member_data)
-    start_workflow(input)
-
-
+    start_workflow(input, execution_name(member_data['member_account'], get_event_id(event)))
@@ -0,0 +1,177 @@
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+import tempfile
+import threading
+import contextlib
+import sh_clients
+import sh_credentials
+import sh_ops_bucket
+import sh_remediator
+import sh_remediator_sm_launcher
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+fields = (
+    'member_account', 'member_email', 'stack_health', 'stack_status', 'stack_updated_at',
+    'template_hash', 'template_current', 'indexed_bucket', 'ops_buckets', 'orphaned_buckets',
+    'checked_at', 'cached', 'error'
+)
+
+parser = argparse.ArgumentParser(description='Report the remediation status of every Member Account')
+parser.add_argument('--org-id', default=os.environ.get('org_id', 'o-a4tlobvmc0'), help='Organization id, used as ExternalId')
+parser.add_argument('--role', default=os.environ.get('assume_role', 'AWSControlTowerExecution'), help='role assumed in each account')
+parser.add_argument('--master-account', default=os.environ.get('master_account'), help='left out of the report')
+parser.add_argument('--home-region', default=os.environ.get('home_region', 'us-east-1'), help='Region of the SHRemediator stacks')
+parser.add_argument('--master-bucket', default=os.environ.get('master_bucket', 'org-sh-ops'), help='bucket holding the current template')
+parser.add_argument('--template-name', default=os.environ.get('cfn_template_name', 'cis-benchmark-remediation.yaml'), help='current template key')
+parser.add_argument('--bucket-prefix', default=os.environ.get('member_bucket', 'sh-ops'),
+    help='ops bucket prefix, {account} is replaced by the account id, else the account id is appended')
+parser.add_argument('--ou-id', help='only the active accounts of this OU')
+parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv', help='output format, written to stdout')
+parser.add_argument('--workers', type=int, default=32, help='accounts checked in parallel')
+parser.add_argument('--ttl', type=int, default=3600, help='seconds an account result is reused from the cache')
+parser.add_argument('--cache-file', default=os.path.join(tempfile.gettempdir(), 'sh-status-report.json'), help='account result cache')
+parser.add_argument('--refresh', action='store_true', help='check every account again')
+
+_output_lock = threading.Lock()
+
+def assume_role(org_id, aws_account_number, role_name):
+    role_session = sh_credentials.get_role_session(org_id, aws_account_number, role_name, cache=False)
+    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
+    return role_session['session']
+
+def load_cache(cache_file):
+    try:
+        with open(cache_file) as cache:
+            return json.load(cache)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print(f'failed in json.load(..) for {cache_file}: {e}', file=sys.stderr)
+        return {}
+
+def save_cache(cache_file, entries):
+    # write then rename, an interrupted run keeps the previous cache
+    with open(cache_file + '.tmp', 'w') as cache:
+        json.dump(entries, cache)
+    os.replace(cache_file + '.tmp', cache_file)
+
+def is_fresh(entry, ttl):
+    return datetime.fromisoformat(entry['checked_at']) + timedelta(seconds=ttl) > datetime.now(timezone.utc)
+
+def get_stack_health(stack):
+    if stack is None:
+        return 'MISSING'
+    stack_state = sh_remediator.get_stack_state(stack['StackStatus'])
+    return {'COMPLETE': 'HEALTHY', 'DELETED': 'MISSING'}.get(stack_state, stack_state)
+
+def list_ops_buckets(member_session, bucket_prefix):
+    s3_client = sh_clients.get_client('s3', member_session)
+    try:
+        response = s3_client.list_buckets()
+    except Exception as e:
+        print(f'failed in list_buckets(..): {e}', file=sys.stderr)
+        raise e
+    # every run of SHOpsBucketCopier that found no index left a <prefix>-<timestamp> bucket
+    return sorted(bucket['Name'] for bucket in response['Buckets'] if bucket['Name'].startswith(bucket_prefix + '-'))
+
+def check_account(args, account, current_hash):
+    member_account = account['member_account']
+    row = dict.fromkeys(fields, '')
+    row.update(account, cached=False, checked_at=datetime.now(timezone.utc).isoformat())
+    member_session = None
+    try:
+        member_session = assume_role(args.org_id, member_account, args.role)
+        cfn_client = sh_remediator.get_cfn_client(member_session, args.home_region)
+        stack = sh_remediator.describe_stack(cfn_client, 'SHRemediator-{}'.format(member_account))
+        row['stack_health'] = get_stack_health(stack)
+        if stack is not None:
+            row['stack_status'] = stack['StackStatus']
+            row['stack_updated_at'] = stack.get('LastUpdatedTime', stack['CreationTime']).isoformat()
+            tags = {tag['Key']: tag['Value'] for tag in stack.get('Tags', [])}
+            row['template_hash'] = tags.get(sh_remediator.template_hash_tag, '')
+            row['template_current'] = row['template_hash'] == current_hash
+        indexed_bucket = sh_ops_bucket.read_bucket_index(member_session, args.home_region)
+        ops_buckets = list_ops_buckets(member_session, sh_ops_bucket.get_bucket_prefix(args.bucket_prefix, member_account))
+        row['indexed_bucket'] = indexed_bucket or ''
+        row['ops_buckets'] = len(ops_buckets)
+        row['orphaned_buckets'] = ' '.join(bucket for bucket in ops_buckets if bucket != indexed_bucket)
+    except Exception as e:
+        row['stack_health'] = 'ERROR'
+        row['error'] = str(e)
+    finally:
+        if member_session is not None:
+            sh_clients.evict_session(member_session)
+    return row
+
+def get_accounts(args):
+    if args.ou_id:
+        return sh_remediator_sm_launcher.list_accounts(args.ou_id)
+    return sh_remediator_sm_launcher.list_org_accounts({args.master_account} if args.master_account else ())
+
+def report(args, out):
+    writer = csv.DictWriter(out, fieldnames=fields) if args.format == 'csv' else None
+    if writer:
+        writer.writeheader()
+    counts = {}
+
+    def emit(row):
+        with _output_lock:
+            counts[row['stack_health']] = counts.get(row['stack_health'], 0) + 1
+            if writer:
+                writer.writerow(row)
+            else:
+                out.write(json.dumps(row) + '\n')
+            out.flush()
+
+    entries = {} if args.refresh else load_cache(args.cache_file)
+    accounts = get_accounts(args)
+    current_hash = sh_ops_bucket.get_template_hash(None, args.master_bucket, args.template_name)
+    stale = []
+    for account in accounts:
+        entry = entries.get(account['member_account'])
+        # a new template version makes every cached template_current stale
+        if entry and is_fresh(entry, args.ttl) and entry.get('current_hash') == current_hash:
+            emit(dict(entry['row'], cached=True))
+        else:
+            stale.append(account)
+    try:
+        if stale:
+            with ThreadPoolExecutor(max_workers=max(1, min(args.workers, len(stale)))) as executor:
+                futures = [executor.submit(check_account, args, account, current_hash) for account in stale]
+                for future in as_completed(futures):
+                    row = future.result()
+                    emit(row)
+                    # failed checks are retried on the next run
+                    if not row['error']:
+                        entries[row['member_account']] = {
+                            'checked_at': row['checked_at'],
+                            'current_hash': current_hash,
+                            'row': row
+                        }
+    finally:
+        save_cache(args.cache_file, entries)
+    print('{} Accounts, {} from cache, {} checked: {}'.format(
+        len(accounts), len(accounts) - len(stale), len(stale),
+        ', '.join('{} {}'.format(count, health) for health, count in sorted(counts.items()))), file=sys.stderr)
+
+def main():
+    args = parser.parse_args()
+    out = sys.stdout
+    # helpers report progress with print, keep stdout for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report(args, out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+step_concurrency = int(os.environ.get('step_concurrency', '8'))
+
+def step(function, *dependencies):
+    # function receives the results of every finished step, keyed by step name
+    return function, dependencies
+
+def run_steps(steps, max_workers=step_concurrency):
+    # each step starts as soon as the steps it depends on finished, so the
+    # wall time is the longest dependency chain instead of the sum of all steps
+    for name, (function, dependencies) in steps.items():
+        unknown = [dependency for dependency in dependencies if dependency not in steps]
+        if unknown:
+            raise ValueError('Step {} depends on unknown steps: {}'.format(name, ', '.join(unknown)))
+    results = {}
+    timings = {}
+    pending = dict(steps)
+    running = {}
+    error = None
+    started = time.perf_counter()
+
+    def timed(name, function):
+        step_started = time.perf_counter()
+        try:
+            return function(results)
+        finally:
+            timings[name] = round((time.perf_counter() - step_started) * 1000, 2)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            if error is None:
+                ready = [name for name, (function, dependencies) in pending.items()
+                    if all(dependency in results for dependency in dependencies)]
+                for name in ready:
+                    function = pending.pop(name)[0]
+                    running[executor.submit(timed, name, function)] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    # no new step starts, the ones in flight are left to finish
+                    error = error or e
+    if error is not None:
+        raise error
+    if pending:
+        raise ValueError('Steps with circular dependencies: {}'.format(', '.join(pending)))
+    timings['total'] = round((time.perf_counter() - started) * 1000, 2)
+    LOGGER.info(f"Step timings (ms): {timings}")
+    return results, timings